@@ -0,0 +1,135 @@
+""" Local stand-in for the Slack Web API that records every call """
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeSlack(object):
+
+    """
+    Threaded HTTP server that answers Slack API calls with ``ok: true``
+
+    Point ``slack.api_url`` at :attr:`url` to use it.
+
+    Parameters
+    ----------
+    host : str, optional
+    port : int, optional
+        Default 0 picks a free port
+    latency : float, optional
+        Seconds to wait before answering each call
+    rate_limit : float, optional
+        Fraction of calls (0-1) that get a 429 response
+    retry_after : float, optional
+        Retry-After value sent with the 429 responses
+
+    """
+
+    def __init__(
+        self, host="127.0.0.1", port=0, latency=0, rate_limit=0, retry_after=1
+    ):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.calls = []
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.server = _ThreadingHTTPServer((host, port), self._make_handler())
+
+    @property
+    def url(self):
+        return "http://%s:%d/api" % self.server.server_address
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):  # pylint: disable=C0103
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                status, data = fake.handle(self.path.rsplit("/", 1)[-1], body)
+                payload = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                if status == 429:
+                    self.send_header("Retry-After", str(fake.retry_after))
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *_):
+                pass
+
+        return Handler
+
+    def handle(self, method, body):
+        """ Record a call and return (status, response json) """
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limit and random.random() < self.rate_limit:
+            with self._lock:
+                self.rate_limited += 1
+            return 429, {"ok": False, "error": "ratelimited"}
+        now = time.time()
+        with self._lock:
+            self.calls.append((now, method, body))
+        ts = "%.6f" % now
+        return 200, {
+            "ok": True,
+            "ts": ts,
+            "channel": body.get("channel"),
+            "message": {"ts": ts},
+        }
+
+    def count(self, method=None):
+        with self._lock:
+            return len([c for c in self.calls if method in (None, c[1])])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Slack API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8900)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds to delay each response"
+    )
+    parser.add_argument(
+        "--rate-limit", type=float, default=0, help="Fraction of calls to 429"
+    )
+    parser.add_argument("--retry-after", type=float, default=1)
+    args = parser.parse_args()
+    fake = FakeSlack(
+        args.host, args.port, args.latency, args.rate_limit, args.retry_after
+    )
+    print("Fake Slack API listening on %s" % fake.url)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Received %d calls, sent %d 429s" % (fake.count(), fake.rate_limited))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark the Config.value JSON column codec
+
+Compares the old path through Pyramid's json renderer with
+:mod:`captionary.jsoncodec` (which uses orjson if it is installed) and the
+stdlib json module, and times a flush of an unchanged ``Config.value``.
+Run with::
+
+    python -m bench.jsoncodec
+
+"""
+import argparse
+import datetime
+import json
+import timeit
+from pyramid.config import Configurator
+from pyramid.renderers import JSON, render
+from pyramid.threadlocal import manager
+from sqlalchemy.orm import sessionmaker
+from captionary import jsoncodec
+from captionary.db import Base, Config, create_engine
+
+VALUE = {
+    "file_id": "F0123456789",
+    "image_url": "https://files.slack.com/files-pri/T0000-F0123456789/image.png",
+    "message_ts": "1546300800.000100",
+}
+
+
+def bench(name, fxn, number):
+    seconds = min(timeit.repeat(fxn, number=number, repeat=5))
+    print("%-32s %8.2fus" % (name, 1e6 * seconds / number))
+
+
+def bench_codecs(number):
+    # The same renderer that captionary.includeme sets up
+    config = Configurator()
+    renderer = JSON()
+    renderer.add_adapter(datetime.datetime, lambda obj, r: jsoncodec.to_timestamp(obj))
+    config.add_renderer("json", renderer)
+    config.commit()
+    manager.push({"registry": config.registry, "request": None})
+    try:
+        bench("encode pyramid render", lambda: render("json", VALUE), number)
+    finally:
+        manager.pop()
+    bench("encode stdlib json.dumps", lambda: json.dumps(VALUE), number)
+    bench("encode jsoncodec", lambda: jsoncodec.dumps(VALUE), number)
+
+    raw = json.dumps(VALUE)
+    bench("decode stdlib json.loads", lambda: json.loads(raw), number)
+    bench("decode jsoncodec", lambda: jsoncodec.loads(raw), number)
+    print("jsoncodec backend: %s" % ("orjson" if jsoncodec.orjson else "json"))
+
+
+def bench_unchanged_flush(number):
+    engine = create_engine({"db.url": "sqlite://"})
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    config = Config(team_id="T1", channel="C1", shard_key=0, value=dict(VALUE))
+    db.add(config)
+    db.commit()
+    config = db.query(Config).get(("T1", "C1"))
+
+    def set_same():
+        config.value["file_id"] = VALUE["file_id"]
+        db.flush()
+
+    bench("set same key + flush", set_same, number)
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-n", "--number", type=int, default=10000)
+    args = parser.parse_args()
+    bench_codecs(args.number)
+    bench_unchanged_flush(args.number // 10)
+
+
+if __name__ == "__main__":
+    main()
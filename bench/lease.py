@@ -0,0 +1,193 @@
+"""
+Check that several processes can share the due contests through leases
+
+Worker processes repeatedly lease a batch of due contests with
+``Config.claim_due``, "move them forward" by clearing the deadline, and
+release the lease, like schedulers running the same shard on several hosts.
+Some leases can be abandoned on purpose to check that they expire and get
+picked up by another worker. At the end every contest must have been moved
+forward exactly once. Run with::
+
+    python -m bench.lease
+    python -m bench.lease --db postgresql://localhost/captionary_bench
+
+The Postgres database is created with the current schema if needed, and only
+rows of the benchmark's own team are touched.
+
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy.orm import sessionmaker
+from captionary.db import (
+    Base,
+    Config,
+    LeaseExpired,
+    State,
+    create_engine,
+    team_shard_key,
+)
+from captionary.scheduler import lease_owner
+from .util import report
+
+TEAM = "T0LEASE"
+
+
+def make_dbmaker(url):
+    settings = {"db.url": url, "sqlite.profile": "production"}
+    return sessionmaker(bind=create_engine(settings))
+
+
+def seed(dbmaker, count):
+    db = dbmaker()
+    db.query(Config).filter(Config.team_id == TEAM).delete()
+    end_dt = datetime.utcnow() - timedelta(seconds=1)
+    db.execute(
+        Config.__table__.insert(),
+        [
+            {
+                "team_id": TEAM,
+                "channel": "C%05d" % i,
+                "state": State.voting,
+                "end_dt": end_dt,
+                "shard_key": team_shard_key(TEAM),
+                "value": {},
+            }
+            for i in range(count)
+        ],
+    )
+    db.commit()
+    db.close()
+
+
+def remaining(db):
+    return (
+        db.query(Config)
+        .filter(Config.team_id == TEAM, Config.end_dt.isnot(None))
+        .count()
+    )
+
+
+def worker(url, args, results):
+    random.seed()
+    dbmaker = make_dbmaker(url)
+    db = dbmaker()
+    owner = lease_owner()
+    processed = []
+    latencies = []
+    expired = 0
+    while True:
+        start = time.perf_counter()
+        keys = Config.claim_due(db, owner, args.lease, limit=args.batch)
+        db.commit()
+        latencies.append(time.perf_counter() - start)
+        if not keys:
+            if not remaining(db):
+                break
+            db.rollback()
+            time.sleep(0.01)
+            continue
+        for team_id, channel in keys:
+            if random.random() < args.abandon:
+                # Pretend this process died while holding the lease
+                continue
+            time.sleep(args.work / 1000.0)
+            config = Config.get_config(db, team_id, channel)
+            if config.lease_owner != owner:
+                continue
+            config.end_dt = None
+            try:
+                Config.release(db, team_id, channel, owner)
+            except LeaseExpired:
+                db.rollback()
+                expired += 1
+            else:
+                db.commit()
+                processed.append(channel)
+    db.close()
+    results.put((processed, latencies, expired))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--db", help="Database url (default: a temporary SQLite file)")
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    parser.add_argument("--contests", type=int, default=2000)
+    parser.add_argument(
+        "--batch", type=int, default=20, help="Contests leased per claim"
+    )
+    parser.add_argument(
+        "--lease", type=float, default=2, help="Lease duration in seconds"
+    )
+    parser.add_argument(
+        "--work", type=float, default=1, help="Milliseconds spent per contest"
+    )
+    parser.add_argument(
+        "--abandon",
+        type=float,
+        default=0.01,
+        help="Fraction of leased contests to abandon without processing",
+    )
+    args = parser.parse_args()
+
+    tempdir = None
+    url = args.db
+    if url is None:
+        tempdir = tempfile.mkdtemp()
+        url = "sqlite:///" + os.path.join(tempdir, "bench.sqlite")
+    dbmaker = make_dbmaker(url)
+    Base.metadata.create_all(bind=dbmaker.kw["bind"])
+    seed(dbmaker, args.contests)
+
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=worker, args=(url, args, results))
+        for _ in range(args.workers)
+    ]
+    start = time.perf_counter()
+    for proc in procs:
+        proc.start()
+    processed = []
+    latencies = []
+    expired = 0
+    for _ in procs:
+        worker_processed, worker_latencies, worker_expired = results.get()
+        processed.extend(worker_processed)
+        latencies.extend(worker_latencies)
+        expired += worker_expired
+    elapsed = time.perf_counter() - start
+    for proc in procs:
+        proc.join()
+
+    report("claim_due (%d workers)" % args.workers, latencies, elapsed)
+    counts = Counter(processed)
+    twice = sum(1 for count in counts.values() if count > 1)
+    print(
+        "%d contests in %.2fs (%.1f/s), %d processed more than once, %d missed"
+        % (
+            args.contests,
+            elapsed,
+            args.contests / elapsed,
+            twice,
+            args.contests - len(counts),
+        )
+    )
+    print("%d leases expired before the contest was moved forward" % expired)
+
+    db = dbmaker()
+    db.query(Config).filter(Config.team_id == TEAM).delete()
+    db.commit()
+    db.close()
+    dbmaker.kw["bind"].dispose()
+    if tempdir is not None:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""
+Load test the web app and the contest queue against a fake Slack server
+
+Replays synthetic ``/event``, ``/command`` and ``/vote`` payloads against the
+WSGI app from :func:`captionary.main`, then moves thousands of contests
+forward with the process_queue and scheduler code paths. Run with::
+
+    python -m bench.load
+
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from webob import Request
+from captionary import main as make_app
+from captionary.actions import proceed_contest_async
+from captionary.cli import _proceed_channel
+from captionary.db import Caption, Config, Outbox, Round, State, team_shard_key
+from captionary.scheduler import Scheduler, lease_owner
+from .fake_slack import FakeSlack
+from .util import report
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def event_request(team_id, channel, file_id):
+    event = {
+        "type": "app_mention",
+        "channel": channel,
+        "files": [
+            {
+                "filetype": "png",
+                "id": file_id,
+                "url_private": "https://files.example.com/%s.png" % file_id,
+                "timestamp": int(time.time()),
+            }
+        ],
+    }
+    return Request.blank(
+        "/event",
+        method="POST",
+        body=json.dumps(
+            {"team_id": team_id, "event_id": "Ev" + uuid.uuid4().hex, "event": event}
+        ).encode("utf-8"),
+        content_type="application/json",
+    )
+
+
+def command_request(team_id, channel, text, user):
+    return Request.blank(
+        "/command",
+        POST={
+            "command": "/caption",
+            "text": text,
+            "team_id": team_id,
+            "channel_id": channel,
+            "user_id": user,
+            "trigger_id": uuid.uuid4().hex,
+        },
+    )
+
+
+def vote_request(team_id, channel, user, caption_id):
+    payload = {
+        "type": "block_actions",
+        "team": {"id": team_id},
+        "channel": {"id": channel},
+        "user": {"id": user},
+        "trigger_id": uuid.uuid4().hex,
+        "actions": [{"action_id": "vote", "value": str(caption_id)}],
+    }
+    return Request.blank("/vote", POST={"payload": json.dumps(payload)})
+
+
+def replay(app, name, requests, concurrency):
+    """ Send requests to the app from a thread pool and report latency """
+
+    def send(request):
+        start = time.perf_counter()
+        response = request.get_response(app)
+        if response.status_code >= 400:
+            raise Exception("%s returned %s" % (request.path, response.status))
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(send, requests))
+    report(name, latencies, time.perf_counter() - start)
+
+
+def wait_for_outbox(registry, timeout=60):
+    """ Wait for the outbox workers to deliver everything """
+    start = time.perf_counter()
+    db = registry.dbmaker()
+    try:
+        while db.query(Outbox).count() and time.perf_counter() - start < timeout:
+            db.rollback()
+            time.sleep(0.05)
+    finally:
+        db.close()
+    return time.perf_counter() - start
+
+
+def claim_contests(registry, owner):
+    """ Lease every due contest, like the scheduler and process_queue do """
+    db = registry.dbmaker()
+    keys = Config.claim_due(
+        db, owner, registry.scheduler_lease, grace=registry.caption_flush_interval
+    )
+    db.commit()
+    db.close()
+    return keys
+
+
+def expire_contests(registry, owner):
+    """ Move every deadline into the past and lease the contests """
+    db = registry.dbmaker()
+    db.query(Config).filter(Config.end_dt.isnot(None)).update(
+        {Config.end_dt: datetime.utcnow() - timedelta(seconds=1)},
+        synchronize_session=False,
+    )
+    db.commit()
+    db.close()
+    return claim_contests(registry, owner)
+
+
+def make_channels(prefix, count, teams):
+    """ Spread ``count`` channels over ``teams`` workspaces """
+    return [("T%03d" % (i % teams), "%s%05d" % (prefix, i)) for i in range(count)]
+
+
+def seed_contests(registry, channels, captions):
+    """ Insert contests that are past their deadline, with captions """
+    db = registry.dbmaker()
+    end_dt = datetime.utcnow() - timedelta(seconds=1)
+    for team_id, channel in channels:
+        value = {"file_id": "F" + channel, "image_url": "https://example.com/i.png"}
+        round_id = Round.start(db, team_id, channel)
+        db.add(
+            Config(
+                team_id=team_id,
+                channel=channel,
+                state=State.captioning,
+                end_dt=end_dt,
+                shard_key=team_shard_key(team_id),
+                round_id=round_id,
+                value=value,
+            )
+        )
+        for i in range(captions):
+            db.add(
+                Caption(
+                    team_id=team_id,
+                    channel=channel,
+                    round_id=round_id,
+                    user="U%05d" % i,
+                    caption="Caption %d" % i,
+                )
+            )
+    db.commit()
+    db.close()
+
+
+def bench_web(app, args):
+    registry = app.registry
+    channels = make_channels("C", args.channels, args.teams)
+    users = ["U%05d" % i for i in range(args.users)]
+
+    replay(
+        app,
+        "POST /event (start contest)",
+        [event_request(team, channel, "F" + channel) for team, channel in channels],
+        args.concurrency,
+    )
+    replay(
+        app,
+        "POST /command (/caption)",
+        [
+            command_request(
+                *random.choice(channels), "Caption %d" % i, random.choice(users)
+            )
+            for i in range(args.commands)
+        ],
+        args.concurrency,
+    )
+
+    # Open the polls so there is something to vote on
+    owner = lease_owner()
+    for team_id, channel in expire_contests(registry, owner):
+        _proceed_channel(registry, owner, team_id, channel)
+    db = registry.dbmaker()
+    captions = db.query(Caption.id, Caption.team_id, Caption.channel).all()
+    db.close()
+    replay(
+        app,
+        "POST /vote",
+        [
+            vote_request(team_id, channel, random.choice(users), caption_id)
+            for caption_id, team_id, channel in (
+                random.choice(captions) for _ in range(args.votes)
+            )
+        ],
+        args.concurrency,
+    )
+    elapsed = wait_for_outbox(registry)
+    print("Outbox drained %.2fs after the last vote" % elapsed)
+
+
+def bench_queue(app, args):
+    registry = app.registry
+
+    channels = make_channels("Q", args.queue_channels, args.teams)
+    seed_contests(registry, channels, args.captions)
+    owner = lease_owner()
+    channels = claim_contests(registry, owner)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = list(
+            executor.map(lambda key: _proceed_channel(registry, owner, *key), channels)
+        )
+    elapsed = time.perf_counter() - start
+    report(
+        "process_queue (%d threads)" % args.workers,
+        [result[2] for result in results],
+        elapsed,
+    )
+    failed = [result for result in results if result[1] is not None]
+    if failed:
+        print("  %d channels failed, first error: %r" % (len(failed), failed[0][1]))
+
+    # The same contests are now in the voting phase; end them on the scheduler
+    scheduler = Scheduler(registry, proceed_contest_async)
+    channels = expire_contests(registry, scheduler.owner)
+    latencies = []
+
+    async def process(key):
+        begin = time.perf_counter()
+        await scheduler.process(*key)
+        latencies.append(time.perf_counter() - begin)
+
+    async def process_all():
+        await asyncio.gather(*[process(key) for key in channels])
+
+    start = time.perf_counter()
+    scheduler.loop.run_until_complete(process_all())
+    report("scheduler (asyncio)", latencies, time.perf_counter() - start)
+    scheduler.loop.run_until_complete(scheduler.aslack.close())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--teams", type=int, default=4)
+    parser.add_argument("--channels", type=int, default=200)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--commands", type=int, default=2000)
+    parser.add_argument("--votes", type=int, default=5000)
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--queue-channels",
+        type=int,
+        default=2000,
+        help="Number of due contests for the process_queue benchmark",
+    )
+    parser.add_argument("--captions", type=int, default=5)
+    parser.add_argument("-w", "--workers", type=int, default=8)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Fake Slack response time"
+    )
+    parser.add_argument(
+        "--rate-limit", type=float, default=0, help="Fraction of Slack calls to 429"
+    )
+    parser.add_argument(
+        "--throttle",
+        action="store_true",
+        help="Apply Slack's real rate limits (default: unlimited)",
+    )
+    parser.add_argument(
+        "--db", help="Database url (default: sqlite in a temporary directory)"
+    )
+    args = parser.parse_args()
+
+    fake = FakeSlack(latency=args.latency, rate_limit=args.rate_limit).start()
+    tempdir = tempfile.mkdtemp()
+    settings = {
+        "db.url": args.db or "sqlite:///" + os.path.join(tempdir, "bench.sqlite"),
+        "slack.api_url": fake.url,
+        "slack.oauth_token": "xoxb-bench",
+        "scheduler.address": "127.0.0.1:%d" % free_port(),
+        "outbox.poll_interval": "0.1",
+        "schema.auto_migrate": "true",
+    }
+    if not args.throttle:
+        for key in ("chat.postMessage", "chat.postEphemeral", "chat.delete", "channel"):
+            settings["slack.rate_limit." + key] = "1e9"
+    try:
+        app = make_app({}, **settings)
+        bench_web(app, args)
+        bench_queue(app, args)
+        print(
+            "Fake Slack received %d calls (%d rate limited)"
+            % (fake.count(), fake.rate_limited)
+        )
+    finally:
+        fake.stop()
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Compare SQLite profiles under concurrent readers and writers
+
+Writer threads submit captions and toggle votes in their own transactions
+while reader threads load the vote tallies, the same mix as the web workers
+and the queue processor hitting one database file. Run with::
+
+    python -m bench.sqlite
+
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from captionary.db import Base, Caption, Config, Vote, create_engine
+from .util import report
+
+TEAM = "T0BENCH"
+
+
+def writer(dbmaker, channels, stop, latencies, errors):
+    db = dbmaker()
+    while not stop.is_set():
+        channel, round_id = random.choice(channels)
+        start = time.perf_counter()
+        try:
+            Caption.add_submission(db, TEAM, channel, "A caption")
+            db.flush()
+            caption = db.query(Caption.id).filter(Caption.round_id == round_id).first()
+            Vote.toggle_vote(db, "U%d" % random.randint(0, 100), caption[0], round_id)
+            db.commit()
+        except OperationalError:
+            db.rollback()
+            errors.append(1)
+        else:
+            latencies.append(time.perf_counter() - start)
+    db.close()
+
+
+def reader(dbmaker, channels, stop, latencies, errors):
+    db = dbmaker()
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            Caption.get_captions_and_votes(db, random.choice(channels)[1])
+            db.rollback()
+        except OperationalError:
+            db.rollback()
+            errors.append(1)
+        else:
+            latencies.append(time.perf_counter() - start)
+    db.close()
+
+
+def run(profile, args):
+    tempdir = tempfile.mkdtemp()
+    settings = {
+        "db.url": "sqlite:///" + os.path.join(tempdir, "bench.sqlite"),
+        "sqlite.profile": profile,
+    }
+    engine = create_engine(settings)
+    Base.metadata.create_all(bind=engine)
+    dbmaker = sessionmaker(bind=engine)
+    channels = []
+    db = dbmaker()
+    for i in range(args.channels):
+        config = Config.get_or_create(db, TEAM, "C%03d" % i)
+        Config.start_contest(db, config, "F", "https://example.com/i.png", None)
+        channels.append((config.channel, config.round_id))
+        Caption.add_submission(db, TEAM, config.channel, "First!")
+    db.commit()
+    db.close()
+
+    stop = threading.Event()
+    results = {"write": ([], []), "read": ([], [])}
+    threads = [
+        threading.Thread(
+            target=writer, args=(dbmaker, channels, stop) + results["write"]
+        )
+        for _ in range(args.writers)
+    ] + [
+        threading.Thread(
+            target=reader, args=(dbmaker, channels, stop) + results["read"]
+        )
+        for _ in range(args.readers)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    shutil.rmtree(tempdir)
+
+    for kind, (latencies, errors) in sorted(results.items()):
+        report("%s %s" % (profile, kind), latencies, args.duration)
+        if errors:
+            print("  %d failed with database is locked" % len(errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-w", "--writers", type=int, default=4)
+    parser.add_argument("-r", "--readers", type=int, default=8)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument(
+        "-d", "--duration", type=float, default=5, help="Seconds per profile"
+    )
+    parser.add_argument(
+        "profiles", nargs="*", default=["safe", "production"], help="Profiles to run"
+    )
+    args = parser.parse_args()
+    for profile in args.profiles:
+        run(profile, args)
+
+
+if __name__ == "__main__":
+    main()
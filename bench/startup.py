@@ -0,0 +1,83 @@
+"""
+Measure cold-start time of the WSGI app and the process_queue command
+
+Each sample runs in a fresh interpreter, the way uWSGI reloads and the
+process_queue cron job pay for it. Run with::
+
+    python -m bench.startup
+
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from .util import percentile
+
+INI = """
+[app:main]
+use = call:captionary:main
+db.url = sqlite:///%(db)s
+slack.oauth_token = xoxb-bench
+outbox.workers = 0
+schema.auto_migrate = %(auto_migrate)s
+"""
+
+APP = "from captionary import main; main({}, **%r)"
+CLI = (
+    "import sys; from captionary.cli import process_queue; "
+    "sys.argv = ['process_queue', %r]; process_queue()"
+)
+
+
+def sample(code, number):
+    """ Run python code in new interpreters and return the wall times """
+    times = []
+    for _ in range(number):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL
+        )
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def print_times(name, times):
+    print(
+        "%-36s p50 %7.1fms  min %7.1fms"
+        % (name, 1000 * percentile(times, 50), 1000 * min(times))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-n", "--number", type=int, default=10)
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        db = os.path.join(tempdir, "bench.sqlite")
+        print_times("python -c pass", sample("pass", args.number))
+        imports = sample("import captionary.views", args.number)
+        print_times("import captionary.views", imports)
+        for auto_migrate in ("true", "false"):
+            settings = {
+                "db.url": "sqlite:///" + db,
+                "slack.oauth_token": "xoxb-bench",
+                "outbox.workers": "0",
+                "schema.auto_migrate": auto_migrate,
+            }
+            ini = os.path.join(tempdir, "bench-%s.ini" % auto_migrate)
+            with open(ini, "w") as ofile:
+                ofile.write(INI % {"db": db, "auto_migrate": auto_migrate})
+            label = "auto_migrate=%s" % auto_migrate
+            print_times("captionary:main " + label, sample(APP % settings, args.number))
+            print_times("process_queue " + label, sample(CLI % ini, args.number))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == "__main__":
+    main()
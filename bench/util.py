@@ -0,0 +1,34 @@
+""" Helpers shared by the benchmarks """
+import time
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of numbers """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def report(name, latencies, elapsed):
+    """ Print throughput and latency percentiles (latencies in seconds) """
+    count = len(latencies)
+    print(
+        "%-28s n=%-6d %8.1f/s  p50 %7.2fms  p99 %7.2fms  max %7.2fms"
+        % (
+            name,
+            count,
+            count / elapsed if elapsed else 0,
+            1000 * percentile(latencies, 50),
+            1000 * percentile(latencies, 99),
+            1000 * max(latencies or [0]),
+        )
+    )
+
+
+def timed(fxn, *args, **kwargs):
+    """ Call a function and return (seconds, result) """
+    start = time.perf_counter()
+    result = fxn(*args, **kwargs)
+    return time.perf_counter() - start, result
@@ -1,18 +1,9 @@
 import calendar
-import os
-import zope.sqlalchemy
 import datetime
 import logging
 from pyramid.config import Configurator
-from pyramid.renderers import JSON, render
+from pyramid.renderers import JSON
 from pyramid.settings import asbool
-from sqlalchemy import engine_from_config, distinct, and_, or_, Column, DateTime, String
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.mutable import Mutable
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import func
-from sqlalchemy.types import TypeDecorator, TEXT
 
 
 __version__ = "0.0.1"
@@ -31,11 +22,16 @@ def includeme(config):
     config.include("pyramid_duh")
     config.include("pyramid_duh.auth")
     config.include("captionary.db")
+    config.include("captionary.teams")
+    config.include("captionary.dedupe")
+    config.include("captionary.batch")
     config.include("captionary.slack")
-
-    config.registry.oauth_token = (
-        settings.get("slack.oauth_token") or os.environ["OAUTH_TOKEN"]
-    )
+    config.include("captionary.scheduler")
+    config.include("captionary.outbox")
+    config.include("captionary.images")
+    config.include("captionary.metrics")
+    config.include("captionary.admission")
+    config.include("captionary.profiling")
 
     # If we're reloading templates, we should also pretty-print json
     reload_templates = asbool(settings.get("pyramid.reload_templates"))
@@ -1,10 +1,13 @@
 from __future__ import print_function, unicode_literals
 from datetime import datetime, timedelta
-import random
 import logging
+from .batch import flush_captions
 from .db import Config, Caption, State
+from .images import contest_image_url, queue_download, stored_image
+from .leaderboard import archive_round
+from .messages import ballot_messages, ballot_timestamps, results_messages
+from .scheduler import notify
 from .util import format_timedelta
-from .slack import SlackException
 
 LOG = logging.getLogger(__name__)
 
@@ -14,13 +17,21 @@ VOTE_DURATION = timedelta(hours=24)
 
 def start_contest(request, channel, image):
     end_dt = datetime.utcnow() + CAPTION_DURATION
-    config = Config.get_or_create(request.db, channel)
+    config = Config.get_or_create(request.db, request.team_id, channel)
 
     file_id = image["id"]
-    image_url = image["url_private"]
     if config.value.get("file_id") == file_id:
         LOG.info("Blocking duplicate contest start %s %s", channel, file_id)
         return
+    # The same picture in another file is only caught if that file was
+    # stored before. A new file isn't downloaded until after the request.
+    filename = stored_image(request, image)
+    if (
+        filename is not None
+        and config.value.get("image_hash") == filename.split(".")[0]
+    ):
+        LOG.info("Blocking duplicate contest start %s %s", channel, filename)
+        return
 
     LOG.info(
         "Detected image in message. Starting new caption contest in channel %s file %s uploaded at %s",
@@ -29,15 +40,18 @@ def start_contest(request, channel, image):
         datetime.fromtimestamp(image["timestamp"]).isoformat(),
     )
 
-    state = config.value.get("state")
-    if state == State.voting:
+    if config.state == State.voting:
         LOG.info("Ending previous vote before starting new contest")
         _end_voting(request, config)
 
-    Config.start_contest(request.db, config, file_id, image_url, end_dt)
-    Caption.clear_captions(request.db, channel)
+    Config.start_contest(
+        request.db, config, file_id, image["url_private"], end_dt, filename
+    )
+    if filename is None:
+        queue_download(request, channel, image)
+    notify(request, request.team_id, channel)
 
-    request.slack.post(
+    request.outbox.post(
         channel,
         "<!channel> New caption contest! Submissions close in %s, and then voting begins! Polls will be open for %s (or until next contest start)"
         % (format_timedelta(CAPTION_DURATION), format_timedelta(VOTE_DURATION)),
@@ -45,87 +59,133 @@ def start_contest(request, channel, image):
     )
 
 
-def proceed_contest(request, channel):
-    config = Config.get_config(request.db, channel)
+def _get_config_to_proceed(request, channel):
+    """ Get the channel's config if the contest can be moved forward """
+    config = Config.get_config(request.db, request.team_id, channel)
     if config is None:
         LOG.warning("Cannot move contest forward on %s: empty config", channel)
-        return
-    state = config.value.get("state")
+        return None
+    state = config.state
     if state == State.none:
         LOG.warning("Cannot move contest forward on %s: config state None", channel)
-    elif state == State.captioning:
-        _start_voting(request, config)
-    elif state == State.voting:
-        _end_voting(request, config)
+    elif state in (State.captioning, State.voting):
+        return config
     else:
         LOG.error("Config %s in bad state: %r. Clearing state...", channel, state)
         request.db.delete(config)
+    return None
+
+
+def proceed_contest(request, channel):
+    config = _get_config_to_proceed(request, channel)
+    if config is None:
+        return
+    if config.state == State.captioning:
+        _start_voting(request, config)
+    else:
+        _end_voting(request, config)
+
+
+async def proceed_contest_async(request, channel):
+    """
+    Coroutine version of :func:`proceed_contest`
+
+    Uses ``request.aslack``, an :class:`~captionary.slack.AsyncSlackAPI`, so
+    that many channels can be processed concurrently on one event loop.
+
+    """
+    config = _get_config_to_proceed(request, channel)
+    if config is None:
+        return
+    if config.state == State.captioning:
+        await _start_voting_async(request, config)
+    else:
+        await _end_voting_async(request, config)
+
+
+def _save_ballot_message(request, config, ts):
+    """ Record a posted ballot page right away, in its own transaction """
+    db = request.registry.dbmaker()
+    try:
+        Config.add_ballot_message(db, config.team_id, config.channel, ts)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _delete_stale_ballot(request, config, stale_ts):
+    """ Delete the pages posted by an earlier attempt that failed part way """
+    for ts in stale_ts:
+        LOG.info("Deleting ballot page %s left on %s", ts, config.channel)
+        request.outbox.delete(config.channel, ts)
 
 
 def _start_voting(request, config):
-    captions = Caption.get_captions(request.db, config.channel)
-    if not captions:
+    flush_captions(request)
+    caption_ids = Caption.get_caption_ids(request.db, config.round_id)
+    if not caption_ids:
         LOG.info("Ending contest %s with no caption submissions", config.channel)
         Config.end_contest(request.db, config)
         return
-    random.shuffle(captions)
-
-    file_id = config.value["file_id"]
-    image_url = config.value["image_url"]
-    attachments = [{"text": file_id, "image_url": image_url}]
-    for i, caption in enumerate(captions):
-        attachments.append(
-            {
-                "text": caption.caption,
-                "callback_id": file_id,
-                "actions": [
-                    {
-                        "name": "vote",
-                        "text": "Vote",
-                        "type": "button",
-                        "value": str(caption.id),
-                        "mrkdwn_in": ["text"],
-                    }
-                ],
-            }
-        )
-
-    resp = request.slack.post(
-        config.channel,
-        "Get out the vote! Polls are open for %s (or until next contest start)"
-        % format_timedelta(VOTE_DURATION),
-        attachments=attachments,
-    )
-    ts = resp["message"]["ts"]
+    stale_ts = ballot_timestamps(config)
+    message_ts = []
+    image_url = contest_image_url(request, config)
+    for text, blocks in ballot_messages(
+        request.db, config, image_url, caption_ids, VOTE_DURATION
+    ):
+        resp = request.slack.post(config.channel, text, blocks=blocks)
+        message_ts.append(resp["message"]["ts"])
+        _save_ballot_message(request, config, message_ts[-1])
+    # Only write in this transaction now, or it would hold the SQLite write
+    # lock that _save_ballot_message needs
+    _delete_stale_ballot(request, config, stale_ts)
     end_dt = datetime.utcnow() + VOTE_DURATION
-    Config.start_voting(request.db, config, ts, end_dt)
+    Config.start_voting(request.db, config, message_ts, end_dt)
+    notify(request, config.team_id, config.channel)
 
 
 def _end_voting(request, config):
-    captions = Caption.get_captions_and_votes(request.db, config.channel)
-    captions.sort(reverse=True)
-
-    file_id = config.value["file_id"]
-    image_url = config.value["image_url"]
-    message = "*Caption results:*"
-    for votes, caption in captions:
-        if votes > 0:
-            message += "\n%d - %s" % (votes, caption)
-        else:
-            message += "\n%s" % caption
-    request.slack.post(
-        config.channel,
-        message,
-        attachments=[{"text": file_id, "image_url": image_url}],
-        mrkdwn=True,
-    )
+    for text, blocks in results_messages(
+        request.db, config, contest_image_url(request, config)
+    ):
+        request.outbox.post(config.channel, text, blocks=blocks)
+    for ts in ballot_timestamps(config):
+        request.outbox.delete(config.channel, ts)
+
+    archive_round(request.db, config)
+    Config.end_contest(request.db, config)
 
-    message_ts = config.value["message_ts"]
 
-    Caption.clear_captions(request.db, config.channel)
-    Config.end_contest(request.db, config)
+# The async transitions only write to the database after their last await.
+# Several of them share one thread, and a SQLite write lock held across an
+# await would block the other transitions' commits.
 
-    try:
-        request.slack.delete(config.channel, message_ts)
-    except SlackException:
-        pass
+
+async def _start_voting_async(request, config):
+    flush_captions(request)
+    caption_ids = Caption.get_caption_ids(request.db, config.round_id)
+    if not caption_ids:
+        LOG.info("Ending contest %s with no caption submissions", config.channel)
+        Config.end_contest(request.db, config)
+        return
+    stale_ts = ballot_timestamps(config)
+    message_ts = []
+    # Post the pages one at a time so they show up in order
+    image_url = contest_image_url(request, config)
+    for text, blocks in ballot_messages(
+        request.db, config, image_url, caption_ids, VOTE_DURATION
+    ):
+        resp = await request.aslack.post(config.channel, text, blocks=blocks)
+        message_ts.append(resp["message"]["ts"])
+        # A short transaction of its own, so no lock is held across an await
+        _save_ballot_message(request, config, message_ts[-1])
+    _delete_stale_ballot(request, config, stale_ts)
+    end_dt = datetime.utcnow() + VOTE_DURATION
+    Config.start_voting(request.db, config, message_ts, end_dt)
+    notify(request, config.team_id, config.channel)
+
+
+async def _end_voting_async(request, config):
+    # Through the outbox, like _end_voting: posting here would send the
+    # results again if the transaction failed and the lease was retried
+    _end_voting(request, config)
@@ -0,0 +1,395 @@
+"""
+Shed load from the Slack webhooks during bursts
+
+When a contest opens or voting starts, a whole channel posts to ``/command``
+and ``/vote`` at the same moment. Slack gives up on a request after 3
+seconds and sends it again, which only adds to the pile. Past a limit, the
+admission tween saves a copy of a webhook in the outbox table, and only then
+acknowledges it with an empty 200. The outbox workers of any process replay
+the deferred requests through the app once there is room again for every
+route, and post a command's reply to its ``response_url``. While there is no
+room the workers leave the deferred requests in the table and send their
+other messages, though one is still replayed every :data:`MAX_REPLAY_WAIT`
+seconds so they are never stuck. Nothing is lost when a worker is recycled
+or the app is deployed, and a request that is replayed twice only takes
+effect once (see :mod:`captionary.dedupe`).
+
+The limits are ``admission.max_in_flight`` requests being handled by this
+process, and ``admission.max_queue_wait`` seconds that a request waited
+before the app saw it. A process only handles more than one request at a
+time with uWSGI ``threads``, so without them only the wait can trigger. The
+wait is measured from the ``X-Request-Start`` header (``t=<seconds>``, as
+nginx sends it with ``$msec``), which the front-end has to set; a warning is
+logged the first time it is missing. Each route starts deferring at its own
+fraction of the limits, ``admission.priority.<route>``: votes first, then
+commands, and events last. When ``admission.max_deferred`` requests are
+already waiting, or the copy can't be saved quickly, the request is rejected
+with a 503 and Slack retries it later. The number that are waiting is kept in
+memory, and counted again from the table by the outbox workers every
+:data:`DEPTH_REFRESH` seconds.
+
+"""
+import base64
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from pyramid.interfaces import IRoutesMapper
+from pyramid.request import Request
+from pyramid.response import Response
+from pyramid.router import Router
+from pyramid.settings import asbool
+from .db import Outbox, lock_timeout
+from .metrics import record_slack_call
+
+LOG = logging.getLogger(__name__)
+
+# Fraction of the limits at which each route starts deferring requests
+PRIORITIES = {"event": 1.0, "command": 0.75, "vote": 0.5}
+# Marks a request that is being replayed from the outbox
+DEFERRED = "captionary.deferred"
+# Outbox path of a deferred request
+REPLAY_JOB = "captionary.admission.replay"
+# A queue wait measured longer ago than this no longer says anything
+QUEUE_WAIT_TTL = 1
+# Seconds after the last replay that the next one runs even without room
+MAX_REPLAY_WAIT = 10
+# Seconds between counts of the deferred requests in the outbox table
+DEPTH_REFRESH = 1
+# Seconds that saving a deferred request waits for a database lock. Slack
+# only waits 3 seconds for the response.
+DEFER_LOCK_TIMEOUT = 0.25
+# Request headers that are saved with a deferred request
+REPLAY_HEADERS = ("Content-Type", "X-Slack-Retry-Num", "X-Slack-Retry-Reason")
+
+
+def parse_request_start(value, now=None):
+    """
+    Get the seconds since a request was received from ``X-Request-Start``
+
+    Accepts ``t=`` followed by seconds, milliseconds or microseconds since
+    the epoch. Returns None if the header is missing or malformed.
+
+    """
+    if not value:
+        return None
+    if value.startswith("t="):
+        value = value[2:]
+    try:
+        start = float(value)
+    except ValueError:
+        return None
+    if start > 1e14:
+        start /= 1e6
+    elif start > 1e11:
+        start /= 1e3
+    now = time.time() if now is None else now
+    return max(now - start, 0)
+
+
+class Admission(object):
+
+    """
+    Decides which webhooks to handle now, and replays the deferred ones
+
+    Parameters
+    ----------
+    registry : :class:`pyramid.registry.Registry`
+    max_in_flight : int
+        Requests handled at once by this process before deferring
+    max_queue_wait : float
+        Seconds a request may wait before the app sees it before deferring
+    max_deferred : int
+        Deferred requests waiting in the outbox, across all processes, past
+        which requests are rejected
+    priorities : dict, optional
+        Route name to the fraction of the limits at which it starts deferring
+        (default :data:`PRIORITIES`)
+
+    """
+
+    def __init__(
+        self,
+        registry,
+        max_in_flight=8,
+        max_queue_wait=1,
+        max_deferred=1000,
+        priorities=None,
+    ):
+        self.registry = registry
+        self.max_in_flight = max_in_flight
+        self.max_queue_wait = max_queue_wait
+        self.max_deferred = max_deferred
+        self.priorities = dict(PRIORITIES if priorities is None else priorities)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._decisions = defaultdict(int)
+        self._queue_wait_total = 0
+        self._queue_wait = (0, 0)
+        self._warned_no_start = False
+        self._last_replay = time.monotonic()
+        self._held_back = False
+        self.deferred_depth = 0
+        self._depth_counted = None
+        self._app = None
+
+    def _busy(self, level, queue_wait):
+        if self.in_flight >= level * self.max_in_flight:
+            return True
+        return queue_wait is not None and queue_wait >= level * self.max_queue_wait
+
+    def _recent_queue_wait(self):
+        wait, measured = self._queue_wait
+        if time.monotonic() - measured > QUEUE_WAIT_TTL:
+            return None
+        return wait
+
+    def missing_request_start(self):
+        """ Warn once that the queue wait can't be measured """
+        with self._lock:
+            if self._warned_no_start:
+                return
+            self._warned_no_start = True
+        LOG.warning(
+            "Request has no X-Request-Start header; admission.max_queue_wait "
+            "only works if the front-end sets it"
+        )
+
+    def record(self, route, decision):
+        with self._lock:
+            self._decisions[route, decision] += 1
+
+    def admit(self, route, queue_wait):
+        """ Count the request as in flight if there is room for it """
+        with self._lock:
+            if queue_wait is not None:
+                self._queue_wait_total += queue_wait
+                self._queue_wait = (queue_wait, time.monotonic())
+            if self._busy(self.priorities[route], queue_wait):
+                return False
+            self.in_flight += 1
+            self._decisions[route, "admitted"] += 1
+            return True
+
+    def enter(self):
+        """ Count a replayed request as in flight """
+        with self._lock:
+            self.in_flight += 1
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+            wake = self._held_back and not self._replay_busy()
+            if wake:
+                self._held_back = False
+        if wake:
+            self.registry.outbox_wake.set()
+
+    def _replay_busy(self):
+        level = min(self.priorities.values())
+        return self._busy(level, self._recent_queue_wait())
+
+    def refresh_depth(self):
+        """ Count the deferred requests of every process, at most every second """
+        now = time.monotonic()
+        with self._lock:
+            if self._depth_counted is not None:
+                if now - self._depth_counted < DEPTH_REFRESH:
+                    return
+            self._depth_counted = now
+        db = self.registry.dbmaker()
+        try:
+            depth = Outbox.count_path(db, REPLAY_JOB)
+        finally:
+            db.close()
+        with self._lock:
+            self.deferred_depth = depth
+
+    def ready(self):
+        """
+        True if there is room to replay a deferred request
+
+        Checked by the outbox workers before they pick up a replay, so that
+        the requests that are still coming in get the first go.
+
+        """
+        self.refresh_depth()
+        with self._lock:
+            if time.monotonic() - self._last_replay >= MAX_REPLAY_WAIT:
+                return True
+            if self._replay_busy():
+                self._held_back = True
+                return False
+            return True
+
+    def defer(self, route, request):
+        """
+        Save a copy of the request in the outbox
+
+        Returns False if there are too many deferred requests already, or if
+        the copy could not be committed within :data:`DEFER_LOCK_TIMEOUT`.
+
+        """
+        with self._lock:
+            if self.deferred_depth >= self.max_deferred:
+                self._decisions[route, "rejected"] += 1
+                return False
+        body = {
+            "channel": "",
+            "route": route,
+            "method": request.method,
+            "path": request.path_qs,
+            "headers": dict(
+                (name, request.headers[name])
+                for name in REPLAY_HEADERS
+                if name in request.headers
+            ),
+            "body": base64.b64encode(request.body).decode("ascii"),
+        }
+        # Its own key, so deferred requests are replayed in parallel
+        key = "deferred:" + uuid.uuid4().hex
+        try:
+            with self.registry.dbmaker.kw["bind"].connect() as conn:
+                with lock_timeout(conn, DEFER_LOCK_TIMEOUT):
+                    db = self.registry.dbmaker(bind=conn)
+                    try:
+                        Outbox.enqueue(db, request.team_id, "", REPLAY_JOB, body, key)
+                        db.commit()
+                    finally:
+                        db.close()
+        except Exception:  # pylint: disable=W0703
+            LOG.exception("Error saving deferred %s request", route)
+            self.record(route, "rejected")
+            return False
+        with self._lock:
+            self.deferred_depth += 1
+            self._decisions[route, "deferred"] += 1
+        self.registry.outbox_wake.set()
+        return True
+
+    def replay(self, body):
+        """ Run a deferred request through the app """
+        route = body["route"]
+        with self._lock:
+            self._last_replay = time.monotonic()
+            self.deferred_depth = max(self.deferred_depth - 1, 0)
+        if self._app is None:
+            # Can't be built in the tween factory, because building a router
+            # calls the tween factories again
+            self._app = Router(self.registry)
+        request = Request.blank(
+            body["path"], method=body["method"], headers=body["headers"]
+        )
+        request.body = base64.b64decode(body["body"])
+        request.environ[DEFERRED] = True
+        response = request.get_response(self._app)
+        self.record(route, "replayed")
+        if route == "command" and response.status_code == 200 and response.body:
+            respond(self.registry, request.POST.get("response_url"), response)
+
+    def get_stats(self):
+        """ Counters and gauges for the metrics endpoint """
+        with self._lock:
+            stats = dict(
+                ("%s_%s" % key, count) for key, count in self._decisions.items()
+            )
+            stats["queue_wait_seconds"] = self._queue_wait_total
+            stats["in_flight"] = self.in_flight
+            stats["deferred_depth"] = self.deferred_depth
+        return stats
+
+
+def replay_job(registry, db, team_id, body):
+    """ Outbox job that replays a deferred request """
+    admission = registry.admission
+    if admission is None:
+        # Deferred before admission control was turned off
+        admission = Admission(registry)
+    admission.replay(body)
+
+
+def respond(registry, response_url, response):
+    """ Send the reply to a deferred slash command to its response_url """
+    if not response_url:
+        return
+    if response.content_type == "application/json":
+        message = json.loads(response.text)
+    else:
+        message = {"text": response.text}
+    if not message.get("text") and not message.get("blocks"):
+        return
+    start = time.perf_counter()
+    resp = registry.slack_session.post(
+        response_url, json=message, timeout=registry.slack_timeout
+    )
+    record_slack_call(registry, "response_url", time.perf_counter() - start)
+    resp.raise_for_status()
+
+
+def admission_tween_factory(handler, registry):
+    admission = registry.admission
+    if admission is None:
+        return handler
+    mapper = registry.queryUtility(IRoutesMapper)
+
+    def admission_tween(request):
+        if request.environ.get(DEFERRED):
+            admission.enter()
+            try:
+                return handler(request)
+            finally:
+                admission.leave()
+        route = mapper(request)["route"]
+        if route is None or route.name not in admission.priorities:
+            return handler(request)
+        if route.name == "event" and b"url_verification" in request.body:
+            # Slack needs the challenge in the response
+            return handler(request)
+        header = request.headers.get("X-Request-Start")
+        if header is None:
+            admission.missing_request_start()
+        queue_wait = parse_request_start(header)
+        if admission.admit(route.name, queue_wait):
+            try:
+                return handler(request)
+            finally:
+                admission.leave()
+        # Label the metrics, since the router never sees the request
+        request.matched_route = route
+        if admission.defer(route.name, request):
+            return Response(status=200)
+        LOG.warning("Could not defer %s request; rejecting it", route.name)
+        return Response(status=503, headers={"Retry-After": "5"})
+
+    return admission_tween
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.admission = None
+    # Registered even when disabled, so requests deferred before a restart
+    # are still replayed
+    config.registry.outbox_jobs[REPLAY_JOB] = replay_job
+    if asbool(settings.get("admission.enabled", False)):
+        priorities = dict(
+            (route, float(settings.get("admission.priority." + route, level)))
+            for route, level in PRIORITIES.items()
+        )
+        admission = Admission(
+            config.registry,
+            int(settings.get("admission.max_in_flight", 8)),
+            float(settings.get("admission.max_queue_wait", 1)),
+            int(settings.get("admission.max_deferred", 1000)),
+            priorities,
+        )
+        config.registry.admission = admission
+        config.registry.outbox_ready[REPLAY_JOB] = admission.ready
+    # Under the metrics so deferred and rejected requests are counted, and
+    # over pyramid_tm so a deferred request never opens a transaction
+    config.add_tween(
+        "captionary.admission.admission_tween_factory",
+        under="captionary.metrics.metrics_tween_factory",
+        over="pyramid_tm.tm_tween_factory",
+    )
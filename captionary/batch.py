@@ -0,0 +1,200 @@
+""" Group caption submissions from concurrent requests into one commit """
+import logging
+import threading
+import time
+import zope.sqlalchemy
+from pyramid.settings import asbool
+from sqlalchemy.exc import IntegrityError
+from .db import Caption, Delivery
+from .dedupe import take_delivery
+
+LOG = logging.getLogger(__name__)
+
+
+class _Submission(object):
+    def __init__(self, team_id, channel, text, user, delivery):
+        self.team_id = team_id
+        self.channel = channel
+        self.text = text
+        self.user = user
+        self.delivery = delivery
+        self.accepted = False
+        self.error = None
+        self.done = threading.Event()
+
+
+class CaptionBatcher(object):
+
+    """
+    Writes caption submissions in batches from a background thread
+
+    :meth:`submit` blocks until the batch containing the submission has
+    been committed, so a caption is never acknowledged to Slack before it is
+    durable. Concurrent requests share the commit instead of each paying for
+    their own. The Slack delivery of each submission is saved in the same
+    commit, and a submission whose delivery was already saved is skipped.
+
+    Parameters
+    ----------
+    registry : :class:`pyramid.registry.Registry`
+    window : float
+        Seconds to wait for more submissions before writing a batch
+    max_size : int
+        Most submissions to write in one batch
+
+    """
+
+    def __init__(self, registry, window=0.005, max_size=500):
+        self.registry = registry
+        self.window = window
+        self.max_size = max_size
+        self._cond = threading.Condition()
+        self._pending = []
+        self._submitted = 0
+        self._written = 0
+        self._thread = None
+
+    def _ensure_thread(self):
+        # Started lazily so that each uWSGI worker gets its own after the fork
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, team_id, channel, text, user=None, delivery=None):
+        """
+        Add a caption and wait for it to be committed
+
+        Returns False if the channel was not accepting captions by the time
+        the batch was written. A repeat of a ``delivery`` key that was
+        already saved is not added again, and returns True.
+
+        """
+        submission = _Submission(team_id, channel, text, user, delivery)
+        with self._cond:
+            self._ensure_thread()
+            self._pending.append(submission)
+            self._submitted += 1
+            self._cond.notify_all()
+        submission.done.wait()
+        if submission.error is not None:
+            raise submission.error
+        return submission.accepted
+
+    def flush(self):
+        """ Wait until every caption submitted so far has been written """
+        with self._cond:
+            target = self._submitted
+            while self._written < target:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                full = len(self._pending) >= self.max_size
+            if not full:
+                time.sleep(self.window)
+            with self._cond:
+                batch = self._pending[: self.max_size]
+                del self._pending[: self.max_size]
+            self._write(batch)
+            with self._cond:
+                self._written += len(batch)
+                self._cond.notify_all()
+
+    def _add(self, db, batch):
+        seen = Delivery.get_keys(db, [sub.delivery for sub in batch if sub.delivery])
+        new = []
+        for sub in batch:
+            if sub.delivery in seen:
+                LOG.info("Skipping repeated caption delivery %s", sub.delivery)
+                sub.accepted = True
+                continue
+            if sub.delivery is not None:
+                seen.add(sub.delivery)
+            new.append(sub)
+        accepting = Caption.add_submissions(
+            db, [(sub.team_id, sub.channel, sub.text, sub.user) for sub in new]
+        )
+        for sub in new:
+            sub.accepted = (sub.team_id, sub.channel) in accepting
+        Delivery.record_batched(
+            db, [sub.delivery for sub in new if sub.accepted and sub.delivery]
+        )
+
+    def _write(self, batch):
+        db = self.registry.dbmaker()
+        try:
+            try:
+                self._add(db, batch)
+                db.commit()
+            except IntegrityError:
+                # A retry was saved by another process since we looked. Once
+                # more, now that its delivery can be seen.
+                db.rollback()
+                self._add(db, batch)
+                db.commit()
+        except Exception as e:  # pylint: disable=W0703
+            LOG.exception("Error writing %d caption submissions", len(batch))
+            db.rollback()
+            for sub in batch:
+                sub.error = e
+        finally:
+            db.close()
+            for sub in batch:
+                sub.done.set()
+
+
+def add_submission(request, channel, text, user=None):
+    """
+    Save a caption submission
+
+    Goes through the :class:`CaptionBatcher` if ``captions.write_behind`` is
+    enabled, otherwise it is added to the request's transaction. Returns
+    False if the channel is not accepting captions.
+
+    The batcher saves the request's Slack delivery with the caption, since
+    the request's transaction doesn't include it.
+
+    """
+    batcher = request.registry.caption_batcher
+    if batcher is None:
+        added = Caption.add_submission(request.db, request.team_id, channel, text, user)
+        # A plain insert statement doesn't tell the transaction to commit
+        zope.sqlalchemy.mark_changed(request.db, request.tm)
+        return added
+    return batcher.submit(request.team_id, channel, text, user, take_delivery(request))
+
+
+def flush_captions(request):
+    """
+    Write the submissions pending in this process's batcher
+
+    Other processes can still have submissions in flight when a contest's
+    deadline passes. Those are covered by the deadline instead: a batch
+    written after the deadline is rejected, and contests are only moved
+    forward ``captions.flush_interval`` seconds after it (default 5 with
+    ``captions.write_behind``), which is time for every batch that made
+    the deadline to commit.
+
+    """
+    batcher = request.registry.caption_batcher
+    if batcher is not None:
+        batcher.flush()
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.caption_batcher = None
+    write_behind = asbool(settings.get("captions.write_behind", False))
+    config.registry.caption_flush_interval = float(
+        settings.get("captions.flush_interval", 5 if write_behind else 0)
+    )
+    if write_behind:
+        config.registry.caption_batcher = CaptionBatcher(
+            config.registry,
+            float(settings.get("captions.batch_window", 0.005)),
+            int(settings.get("captions.batch_size", 500)),
+        )
@@ -0,0 +1,131 @@
+""" Read-through cache of each channel's contest state """
+import logging
+import threading
+import time
+from datetime import datetime
+
+LOG = logging.getLogger(__name__)
+
+
+class LocalStore(object):
+
+    """ Per-process store for :class:`StateCache` """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        """ Get the (value, expires) stored under a key, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+            return entry
+
+    def set(self, key, value, expires):
+        with self._lock:
+            self._entries[key] = (value, expires)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class UWSGIStore(object):
+
+    """
+    Store for :class:`StateCache` that is shared by all uWSGI workers
+
+    Parameters
+    ----------
+    name : str
+        Name of a cache declared with the ``cache2`` uWSGI option
+
+    """
+
+    def __init__(self, name):
+        import uwsgi
+
+        self.uwsgi = uwsgi
+        self.name = name
+
+    def get(self, key):
+        raw = self.uwsgi.cache_get(key, self.name)
+        if raw is None:
+            return None
+        value, expires = raw.decode("utf-8").rsplit("|", 1)
+        expires = float(expires)
+        if expires <= time.time():
+            return None
+        return value or None, expires
+
+    def set(self, key, value, expires):
+        raw = "%s|%f" % (value or "", expires)
+        # uWSGI expires whole seconds, so round up and check the exact time in get
+        timeout = max(int(expires - time.time()) + 1, 1)
+        self.uwsgi.cache_update(key, raw.encode("utf-8"), timeout, self.name)
+
+    def delete(self, key):
+        self.uwsgi.cache_del(key, self.name)
+
+
+class StateCache(object):
+
+    """
+    Caches the contest state of each channel for a short time
+
+    An entry never outlives the contest deadline, because that is when the
+    scheduler changes the state from another process. Changes made with the
+    :class:`~captionary.db.Config` methods invalidate the entry, but only in
+    this process (or in all uWSGI workers, with :class:`UWSGIStore`), so
+    ``ttl`` bounds how long other processes can see an old state.
+
+    Parameters
+    ----------
+    ttl : float
+        Seconds to keep an entry. 0 disables the cache.
+    store : object, optional
+        Where to keep the entries (default :class:`LocalStore`)
+
+    """
+
+    def __init__(self, ttl, store=None):
+        self.ttl = ttl
+        self.store = store or LocalStore()
+
+    def get_state(self, channel, load):
+        """
+        Get a channel's state, calling ``load`` to fetch it on a miss
+
+        ``load`` returns the (state, end_dt) of the channel.
+
+        """
+        if not self.ttl:
+            return load()[0]
+        entry = self.store.get(channel)
+        if entry is not None:
+            return entry[0]
+        state, end_dt = load()
+        expires = time.time() + self.ttl
+        if end_dt is not None:
+            until_end = (end_dt - datetime.utcnow()).total_seconds()
+            expires = min(expires, time.time() + until_end)
+        self.store.set(channel, state, expires)
+        return state
+
+    def invalidate(self, channel):
+        self.store.delete(channel)
+
+
+def create_state_cache(settings):
+    ttl = float(settings.get("state_cache.ttl", 10))
+    name = settings.get("state_cache.uwsgi_cache")
+    store = None
+    if name:
+        try:
+            store = UWSGIStore(name)
+        except ImportError:
+            LOG.warning("Not running in uWSGI; state cache is per-process")
+    return StateCache(ttl, store)
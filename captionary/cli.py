@@ -1,22 +1,211 @@
 import logging
 import argparse
-import transaction
-from pyramid.paster import bootstrap
-from .actions import proceed_contest
-from .db import Config
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pyramid.paster import bootstrap, get_appsettings
+from .actions import proceed_contest, proceed_contest_async
+from .db import Caption, Config, Team, create_engine, init_schema
+from .outbox import flush_outbox
+from .scheduler import (
+    JobRequest,
+    Scheduler,
+    compact_rounds,
+    lease_owner,
+    parse_address,
+)
+
+LOG = logging.getLogger(__name__)
+
+
+def _proceed_channel(registry, owner, team_id, channel):
+    """ Move one leased contest forward in its own transaction """
+    request = JobRequest(registry, team_id)
+    start = time.time()
+    try:
+        with request.tm:
+            config = Config.get_config(request.db, team_id, channel)
+            # Skip the contest if the lease expired and someone else took it
+            if config is not None and config.lease_owner == owner:
+                proceed_contest(request, channel)
+                Config.release(request.db, team_id, channel, owner)
+    except Exception as e:  # pylint: disable=W0703
+        LOG.exception("Error moving contest forward on %s %s", team_id, channel)
+        return channel, e, time.time() - start
+    finally:
+        request.close()
+    return channel, None, time.time() - start
+
+
+def _proceed_channels(registry, owner, channels, workers):
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for channel, error, elapsed in executor.map(
+            lambda key: _proceed_channel(registry, owner, *key), channels
+        ):
+            if error is None:
+                print("%s: ok (%.2fs)" % (channel, elapsed))
+            else:
+                failed += 1
+                print("%s: failed (%.2fs): %r" % (channel, elapsed, error))
+    return failed
 
 
 def process_queue():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        description="Move forward every contest that is past its deadline"
+    )
     parser.add_argument("config", help="config file")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of channels to process in parallel (default %(default)s)",
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        action="store_true",
+        help="Write a sampling profile of the run to profiling.directory",
+    )
 
     args = parser.parse_args()
     logging.basicConfig()
 
     env = bootstrap(args.config)
+    registry = env["registry"]
+    request = env["request"]
+    profiler = registry.profiler
+    if args.profile and profiler is None:
+        parser.error("--profile needs profiling.directory in the config")
+    # Lease the contests so that other copies of this command, or a
+    # scheduler, don't move them forward too
+    owner = lease_owner()
+    with request.tm:
+        channels = Config.claim_due(
+            request.db,
+            owner,
+            registry.scheduler_lease,
+            grace=registry.caption_flush_interval,
+        )
 
+    if args.profile:
+        with profiler.profile("process_queue", all_threads=True):
+            failed = _proceed_channels(registry, owner, channels, args.workers)
+    else:
+        failed = _proceed_channels(registry, owner, channels, args.workers)
+    print("%d channels processed, %d failed" % (len(channels), failed))
+
+    # Deliver the queued Slack calls before exiting
+    flush_outbox(registry)
+    env["closer"]()
+    if failed:
+        sys.exit(1)
+
+
+def run_scheduler():
+    parser = argparse.ArgumentParser(
+        description="Long-running process that moves contests forward"
+    )
+    parser.add_argument("config", help="config file")
+    parser.add_argument(
+        "-s",
+        "--shard",
+        type=int,
+        default=0,
+        help="Index of this process's address in scheduler.address, when "
+        "running one scheduler per shard (default %(default)s)",
+    )
+    parser.add_argument(
+        "-l",
+        "--listen",
+        type=parse_address,
+        help="host:port to listen on instead of the shard's address, when "
+        "running more than one scheduler for a shard",
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    env = bootstrap(args.config)
+    registry = env["registry"]
+    settings = registry.settings
+    if registry.profiler is not None:
+        # kill -USR2 <pid> profiles the next tick that moves contests forward
+        signal.signal(signal.SIGUSR2, registry.profiler.request_tick)
+    scheduler = Scheduler(
+        registry,
+        proceed_contest_async,
+        float(settings.get("scheduler.resync_interval", 300)),
+        args.shard,
+        args.listen,
+    )
+    scheduler.run()
+
+
+def check_votes():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the caption vote counts from the raw votes"
+    )
+    parser.add_argument("config", help="config file")
+
+    args = parser.parse_args()
+    logging.basicConfig()
+
+    env = bootstrap(args.config)
+    request = env["request"]
+    with request.tm:
+        fixed = Caption.rebuild_vote_counts(request.db)
+    print("Fixed %d captions with the wrong vote count" % fixed)
+    env["closer"]()
+
+
+def compact():
+    parser = argparse.ArgumentParser(
+        description="Delete the captions and votes of rounds that ended a while ago"
+    )
+    parser.add_argument("config", help="config file")
+
+    args = parser.parse_args()
+    logging.basicConfig()
+
+    env = bootstrap(args.config)
+    print("Compacted %d rounds" % compact_rounds(env["registry"]))
+    env["closer"]()
+
+
+def migrate_db():
+    parser = argparse.ArgumentParser(
+        description="Create the database tables and upgrade old schemas"
+    )
+    parser.add_argument("config", help="config file")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # Only needs the engine, not the whole app with its worker threads
+    settings = get_appsettings(args.config)
+    engine = create_engine(settings)
+    init_schema(engine, settings.get("slack.team_id", ""))
+    engine.dispose()
+
+
+def add_team():
+    parser = argparse.ArgumentParser(
+        description="Add a Slack workspace, or update its OAuth token"
+    )
+    parser.add_argument("config", help="config file")
+    parser.add_argument("team_id", help="Slack team id (T...)")
+    parser.add_argument("token", help="Bot OAuth token for the team")
+
+    args = parser.parse_args()
+    logging.basicConfig()
+
+    env = bootstrap(args.config)
     request = env["request"]
-    configs = Config.get_ended_configs(request.db)
-    for config in configs:
-        proceed_contest(request, config.channel)
-    transaction.commit()
+    with request.tm:
+        Team.set_token(request.db, args.team_id, args.token)
+    print("Saved token for team %s" % args.team_id)
+    env["closer"]()
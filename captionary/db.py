@@ -1,28 +1,83 @@
 import json
-import time
+import logging
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import zope.sqlalchemy
-from pyramid.renderers import render
+from pyramid.settings import asbool
 from sqlalchemy import (
     engine_from_config,
+    event,
+    bindparam,
+    inspect,
+    text,
     Column,
+    DateTime,
+    Index,
+    LargeBinary,
     String,
     UnicodeText,
     Integer,
     ForeignKey,
     func,
+    literal,
+    and_,
+    case,
+    or_,
+    select,
+    tuple_,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import Mutable
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker, relationship, backref
-from sqlalchemy.interfaces import PoolListener
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.types import TypeDecorator, TEXT
+from . import jsoncodec
+from .cache import create_state_cache
 
+LOG = logging.getLogger(__name__)
 Base = declarative_base()  # pylint: disable=C0103
 
 
-class ForeignKeysListener(PoolListener):
-    def connect(self, dbapi_con, con_record):
-        db_cursor = dbapi_con.execute("pragma foreign_keys=ON")
+class LeaseExpired(Exception):
+    pass
+
+
+# PRAGMAs run on every new SQLite connection, selected with sqlite.profile
+SQLITE_PROFILES = {
+    "safe": {"foreign_keys": "ON"},
+    # Readers don't block the writer and vice versa, and a writer waits for
+    # the lock instead of failing with "database is locked"
+    "production": {
+        "busy_timeout": "5000",
+        "foreign_keys": "ON",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": "-16000",
+        "mmap_size": "268435456",
+        "temp_store": "MEMORY",
+    },
+}
+
+
+# Each team hashes to one of this many shard keys. A scheduler shard handles a
+# contiguous range of them (see :func:`shard_key_range`).
+SHARD_KEYS = 4096
+
+
+def team_shard_key(team_id):
+    return zlib.crc32(team_id.encode("utf-8")) % SHARD_KEYS
+
+
+def shard_key_range(index, count):
+    """ Get the [start, end) shard keys handled by shard ``index`` of ``count`` """
+    return index * SHARD_KEYS // count, (index + 1) * SHARD_KEYS // count
+
+
+def shard_for_team(team_id, count):
+    """ Get the index of the shard that handles a team """
+    return team_shard_key(team_id) * count // SHARD_KEYS
 
 
 class State(object):
@@ -39,12 +94,12 @@ class JSONEncodedDict(TypeDecorator):  # pylint: disable=W0223
 
     def process_bind_param(self, value, dialect):
         if value is not None:
-            value = render("json", value)
+            value = jsoncodec.dumps(value)
         return value
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            value = json.loads(value)
+            value = jsoncodec.loads(value)
         return value
 
 
@@ -67,6 +122,9 @@ class MutableDict(Mutable, dict):
 
     def __setitem__(self, key, value):
         "Detect dictionary set events and emit change events."
+        if key in self and self[key] == value:
+            # Don't make the flush write the same JSON back
+            return
         dict.__setitem__(self, key, value)
         self.changed()
 
@@ -77,101 +135,532 @@ class MutableDict(Mutable, dict):
 
     def pop(self, key, default=None):
         "Detect dictionary pop events and emit change events."
-        dict.pop(self, key, default)
+        if key not in self:
+            return default
+        value = dict.pop(self, key)
         self.changed()
+        return value
 
 
 MutableDict.associate_with(JSONEncodedDict)
 
 
+def _state_key(team_id, channel):
+    return "%s:%s" % (team_id, channel)
+
+
+def _invalidate_state(db, config):
+    """ Drop a channel from the state cache now and when the session commits """
+    cache = db.info.get("state_cache")
+    if cache is not None:
+        key = _state_key(config.team_id, config.channel)
+        cache.invalidate(key)
+        db.info.setdefault("stale_channels", set()).add(key)
+
+
+def _after_commit(db):
+    # Another request may have cached the old state before we committed
+    cache = db.info.get("state_cache")
+    for channel in db.info.pop("stale_channels", ()):
+        cache.invalidate(channel)
+
+
+def _after_rollback(db):
+    db.info.pop("stale_channels", None)
+
+
+class Team(Base):
+
+    """ A Slack workspace that has installed the app """
+
+    __tablename__ = "teams"
+    team_id = Column(String(20), primary_key=True)
+    access_token = Column(String(255), nullable=False)
+
+    @classmethod
+    def get_token(cls, db, team_id):
+        return db.query(cls.access_token).filter(cls.team_id == team_id).scalar()
+
+    @classmethod
+    def set_token(cls, db, team_id, access_token):
+        db.merge(cls(team_id=team_id, access_token=access_token))
+
+
+class Round(Base):
+
+    """
+    One contest in a channel
+
+    Captions and votes belong to a round, so starting a contest only has to
+    point the channel's config at a new round. Rounds that ended a while
+    ago are deleted in batches by :meth:`compact`, off the request path.
+
+    """
+
+    __tablename__ = "rounds"
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    team_id = Column(String(20), nullable=False)
+    channel = Column(String(20), nullable=False)
+    started = Column(DateTime, nullable=False)
+    ended = Column(DateTime, index=True)
+
+    @classmethod
+    def start(cls, db, team_id, channel):
+        """ Create a round and return its id """
+        new_round = cls(team_id=team_id, channel=channel, started=datetime.utcnow())
+        db.add(new_round)
+        db.flush()
+        return new_round.id
+
+    @classmethod
+    def end(cls, db, round_id):
+        db.query(cls).filter(cls.id == round_id, cls.ended.is_(None)).update(
+            {cls.ended: datetime.utcnow()}, synchronize_session=False
+        )
+
+    @classmethod
+    def compact(cls, db, before, limit=100):
+        """
+        Delete rounds that ended before a datetime, with their captions and votes
+
+        At most ``limit`` rounds are deleted, so the caller can commit in
+        small batches. Returns the number of rounds deleted.
+
+        """
+        query = db.query(cls.id).filter(cls.ended < before).order_by(cls.ended)
+        round_ids = [row[0] for row in query.limit(limit)]
+        if not round_ids:
+            return 0
+        for model in (Vote, Caption):
+            db.query(model).filter(model.round_id.in_(round_ids)).delete(
+                synchronize_session=False
+            )
+        db.query(cls).filter(cls.id.in_(round_ids)).delete(synchronize_session=False)
+        return len(round_ids)
+
+
 class Config(Base):
     __tablename__ = "configs"
+    team_id = Column(String(20), primary_key=True)
     channel = Column(String(20), primary_key=True)
+    state = Column(String(20))
+    end_dt = Column(DateTime, index=True)
+    shard_key = Column(Integer, nullable=False, index=True)
+    # The current round, or None between contests
+    round_id = Column(Integer)
+    # Lease held by the process that is moving the contest forward
+    lease_owner = Column(String(64))
+    locked_until = Column(DateTime)
     value = Column(JSONEncodedDict(), nullable=False)
 
     @classmethod
-    def start_contest(cls, db, config, file_id, image_url, end_dt):
+    def start_contest(cls, db, config, file_id, image_url, end_dt, image_file=None):
         config.value["file_id"] = file_id
         config.value["image_url"] = image_url
-        config.value["end"] = end_dt
-        config.value["state"] = State.captioning
+        if image_file is None:
+            config.value.pop("image_file")
+            config.value.pop("image_hash")
+        else:
+            config.value["image_file"] = image_file
+            config.value["image_hash"] = image_file.split(".")[0]
+        if config.round_id is not None:
+            Round.end(db, config.round_id)
+        config.round_id = Round.start(db, config.team_id, config.channel)
+        config.end_dt = end_dt
+        config.state = State.captioning
         db.merge(config)
+        _invalidate_state(db, config)
+
+    @classmethod
+    def set_image_file(cls, db, team_id, channel, file_id, image_file):
+        """ Link a contest to the stored copy of its image, if it's still running """
+        config = cls.get_config(db, team_id, channel)
+        if config is None or config.value.get("file_id") != file_id:
+            return
+        config.value["image_file"] = image_file
+        config.value["image_hash"] = image_file.split(".")[0]
+
+    @classmethod
+    def add_ballot_message(cls, db, team_id, channel, ts):
+        """
+        Record one posted ballot message before voting has started
+
+        Called in its own transaction as each page is posted, so the pages of
+        a transition that fails part way can be deleted when it is retried.
+
+        """
+        config = cls.get_config(db, team_id, channel)
+        if config is None:
+            return
+        message_ts = config.value.get("message_ts") or []
+        if not isinstance(message_ts, list):
+            message_ts = [message_ts]
+        config.value["message_ts"] = message_ts + [ts]
 
     @classmethod
     def start_voting(cls, db, config, message_ts, end_dt):
+        """ ``message_ts`` is the list of timestamps of the ballot messages """
         config.value["message_ts"] = message_ts
-        config.value["end"] = end_dt
-        config.value["state"] = State.voting
+        config.end_dt = end_dt
+        config.state = State.voting
         db.merge(config)
+        _invalidate_state(db, config)
+
+    @classmethod
+    def claim_due(cls, db, owner, lease, limit=None, shard=None, grace=0):
+        """
+        Lease the contests that are past their deadline
+
+        Contests leased by another owner are skipped until the lease expires.
+        On PostgreSQL the candidates are selected with ``FOR UPDATE SKIP
+        LOCKED``, so concurrent claims don't wait on each other. On SQLite the
+        conditional UPDATE alone decides who gets each contest.
+
+        The caller should commit right away, and :meth:`release` the lease in
+        the transaction that moves the contest forward. That fails if the lease
+        expired and the contest was claimed again, so the changes aren't
+        committed twice.
+
+        Parameters
+        ----------
+        owner : str
+            Unique id of the claiming process
+        lease : float
+            Seconds until the lease expires and another process can claim it
+        limit : int, optional
+            Claim at most this many contests
+        shard : tuple, optional
+            (index, count) to only claim the teams handled by that shard
+        grace : float, optional
+            Only claim contests that are this many seconds past their deadline
+
+        Returns
+        -------
+        keys : list
+            The (team_id, channel) of the contests leased to ``owner``
+
+        """
+        now = datetime.utcnow()
+        until = now + timedelta(seconds=lease)
+        free = or_(cls.locked_until.is_(None), cls.locked_until <= now)
+        due = select([cls.team_id, cls.channel]).where(
+            and_(cls.end_dt <= now - timedelta(seconds=grace), free)
+        )
+        if shard is not None:
+            start, end = shard_key_range(*shard)
+            due = due.where(and_(cls.shard_key >= start, cls.shard_key < end))
+        due = due.order_by(cls.end_dt).correlate(None)
+        if limit is not None:
+            due = due.limit(limit)
+        if db.get_bind().dialect.name == "postgresql":
+            due = due.with_for_update(skip_locked=True)
+        db.query(cls).filter(tuple_(cls.team_id, cls.channel).in_(due), free).update(
+            {cls.lease_owner: owner, cls.locked_until: until}, synchronize_session=False
+        )
+        query = db.query(cls.team_id, cls.channel).filter(
+            cls.lease_owner == owner, cls.locked_until == until
+        )
+        return [tuple(row) for row in query]
 
     @classmethod
-    def get_ended_configs(cls, db):
-        configs = db.query(cls)
-        now = time.time()
-        return [c for c in configs if "end" in c.value and c.value["end"] < now]
+    def release(cls, db, team_id, channel, owner):
+        """
+        Give up a lease taken with :meth:`claim_due`
+
+        Raises :class:`LeaseExpired` if ``owner`` no longer holds the lease.
+        The row stays locked until the transaction ends, so once this returns
+        nobody else can take the contest before the commit.
+
+        """
+        count = (
+            db.query(cls)
+            .filter(
+                cls.team_id == team_id,
+                cls.channel == channel,
+                cls.lease_owner == owner,
+            )
+            .update(
+                {cls.lease_owner: None, cls.locked_until: None},
+                synchronize_session=False,
+            )
+        )
+        if count == 0:
+            raise LeaseExpired("Lost the lease on %s %s" % (team_id, channel))
+
+    @classmethod
+    def get_deadlines(cls, db, keys=None, shard=None):
+        """
+        Get (team_id, channel, deadline) for every contest with a deadline
+
+        The deadline is ``end_dt``, or the end of the contest's lease if that
+        is later, since nobody else can move the contest forward before then.
+
+        Parameters
+        ----------
+        keys : list, optional
+            Only get these (team_id, channel) pairs
+        shard : tuple, optional
+            (index, count) to only get the teams handled by that shard
+
+        """
+        deadline = case(
+            [(cls.locked_until > cls.end_dt, cls.locked_until)], else_=cls.end_dt
+        )
+        query = db.query(cls.team_id, cls.channel, deadline).filter(
+            cls.end_dt.isnot(None)
+        )
+        if keys is not None:
+            if not keys:
+                return []
+            query = query.filter(
+                or_(
+                    *[
+                        and_(cls.team_id == team_id, cls.channel == channel)
+                        for team_id, channel in keys
+                    ]
+                )
+            )
+        if shard is not None:
+            start, end = shard_key_range(*shard)
+            query = query.filter(cls.shard_key >= start, cls.shard_key < end)
+        return query.all()
+
+    @classmethod
+    def set_deadline(cls, db, config, end_dt):
+        config.end_dt = end_dt
+        db.merge(config)
+        _invalidate_state(db, config)
 
     @classmethod
-    def get_config(cls, db, channel):
-        return db.query(cls).get(channel)
+    def get_config(cls, db, team_id, channel):
+        return db.query(cls).get((team_id, channel))
 
     @classmethod
-    def get_or_create(cls, db, channel):
-        config = db.query(cls).get(channel)
+    def get_or_create(cls, db, team_id, channel):
+        config = db.query(cls).get((team_id, channel))
         if config is None:
-            config = cls(channel=channel, value={})
+            config = cls(
+                team_id=team_id,
+                channel=channel,
+                shard_key=team_shard_key(team_id),
+                value={},
+            )
             db.merge(config)
         return config
 
     @classmethod
-    def get_contest_state(cls, db, channel):
-        config = db.query(cls).get(channel)
-        if config is not None:
-            return config.value.get("state")
+    def get_contest_state(cls, db, team_id, channel):
+        """ Get a channel's state, from the state cache if possible """
+
+        def load():
+            query = db.query(cls.state, cls.end_dt).filter(
+                cls.team_id == team_id, cls.channel == channel
+            )
+            return query.first() or (None, None)
+
+        cache = db.info.get("state_cache")
+        if cache is None:
+            return load()[0]
+        return cache.get_state(_state_key(team_id, channel), load)
 
     @classmethod
     def end_contest(cls, db, config):
         config.value.pop("file_id")
         config.value.pop("image_url")
+        config.value.pop("image_file")
+        config.value.pop("image_hash")
         config.value.pop("message_ts")
-        config.value.pop("state")
-        config.value.pop("end")
+        if config.round_id is not None:
+            Round.end(db, config.round_id)
+        config.round_id = None
+        config.state = None
+        config.end_dt = None
         db.merge(config)
+        _invalidate_state(db, config)
 
 
 class Caption(Base):
     __tablename__ = "captions"
     id = Column(Integer, autoincrement=True, primary_key=True)
+    team_id = Column(String(20), nullable=False, server_default="")
     channel = Column(String(20), index=True, nullable=False)
+    round_id = Column(Integer, index=True)
+    # Who submitted it, if known
+    user = Column(String(20))
     caption = Column(UnicodeText(), nullable=False)
+    vote_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     @classmethod
-    def add_submission(cls, db, channel, text):
-        db.add(cls(channel=channel, caption=text))
+    def add_submission(cls, db, team_id, channel, text, user=None):
+        """
+        Add a caption to the channel's current round
+
+        The round is read in the same statement as the insert, and only if
+        the channel is still accepting captions, so a round that ends at the
+        same moment can't leave a caption without one. Returns False if
+        nothing was added.
+
+        """
+        current_round = select(
+            [
+                Config.team_id,
+                Config.channel,
+                Config.round_id,
+                literal(user, String),
+                literal(text, UnicodeText),
+            ]
+        ).where(
+            and_(
+                Config.team_id == team_id,
+                Config.channel == channel,
+                Config.state == State.captioning,
+                Config.round_id.isnot(None),
+                or_(Config.end_dt.is_(None), Config.end_dt > datetime.utcnow()),
+            )
+        )
+        insert = cls.__table__.insert().from_select(
+            ["team_id", "channel", "round_id", "user", "caption"], current_round
+        )
+        return db.execute(insert).rowcount == 1
 
     @classmethod
-    def get_captions(cls, db, channel):
-        return list(db.query(cls).filter(cls.channel == channel))
+    def add_submissions(cls, db, submissions):
+        """
+        Insert many (team_id, channel, text, user) submissions with one statement
+
+        Submissions to channels that are no longer accepting captions, or
+        that are past their deadline, are dropped. Returns the set of
+        (team_id, channel) that accepted them.
+
+        """
+        keys = set((sub[0], sub[1]) for sub in submissions)
+        query = db.query(Config.team_id, Config.channel, Config.round_id).filter(
+            Config.channel.in_(set(channel for _, channel in keys)),
+            Config.state == State.captioning,
+            Config.round_id.isnot(None),
+            or_(Config.end_dt.is_(None), Config.end_dt > datetime.utcnow()),
+        )
+        rounds = dict(
+            ((team_id, channel), round_id)
+            for team_id, channel, round_id in query
+            if (team_id, channel) in keys
+        )
+        rows = [
+            {
+                "team_id": team_id,
+                "channel": channel,
+                "round_id": rounds[(team_id, channel)],
+                "user": user,
+                "caption": text,
+            }
+            for team_id, channel, text, user in submissions
+            if (team_id, channel) in rounds
+        ]
+        if rows:
+            db.execute(cls.__table__.insert(), rows)
+        return set(rounds)
 
     @classmethod
-    def get_captions_and_votes(cls, db, channel):
-        return list(
-            db.query(func.count(Vote.user), cls.caption)
-            .select_from(cls)
-            .outerjoin(Vote)
-            .filter(cls.channel == channel)
-            .group_by(cls.id)
+    def get_captions(cls, db, round_id):
+        return list(db.query(cls).filter(cls.round_id == round_id))
+
+    @classmethod
+    def get_caption_ids(cls, db, round_id):
+        query = db.query(cls.id).filter(cls.round_id == round_id)
+        return [row[0] for row in query]
+
+    @classmethod
+    def get_voting_round_id(cls, db, team_id, channel, caption_id):
+        """
+        Get the round of a caption that can be voted on
+
+        Returns None unless the caption belongs to the current round of that
+        team's channel, and the round is in voting.
+
+        """
+        query = (
+            db.query(cls.round_id)
+            .join(
+                Config,
+                and_(
+                    Config.team_id == cls.team_id,
+                    Config.channel == cls.channel,
+                    Config.round_id == cls.round_id,
+                ),
+            )
+            .filter(
+                cls.id == caption_id,
+                cls.team_id == team_id,
+                cls.channel == channel,
+                Config.state == State.voting,
+            )
         )
+        return query.scalar()
 
     @classmethod
-    def clear_captions(cls, db, channel):
-        db.query(cls).filter(cls.channel == channel).delete(synchronize_session=False)
+    def get_captions_by_id(cls, db, ids):
+        """ Load captions, returned in the same order as ``ids`` """
+        captions = dict((c.id, c) for c in db.query(cls).filter(cls.id.in_(ids)))
+        return [captions[i] for i in ids if i in captions]
 
     @classmethod
-    def get_votes(cls, db, user, channel):
+    def iter_results(cls, db, round_id, batch_size=500):
+        """
+        Yield (vote_count, caption) for a round, most votes first
+
+        Rows are loaded ``batch_size`` at a time, and no query is left open
+        between batches.
+
+        """
+        query = (
+            db.query(cls.id, cls.vote_count, cls.caption)
+            .filter(cls.round_id == round_id)
+            .order_by(cls.vote_count.desc(), cls.id)
+        )
+        last = None
+        while True:
+            page = query
+            if last is not None:
+                page = page.filter(
+                    or_(
+                        cls.vote_count < last.vote_count,
+                        and_(cls.vote_count == last.vote_count, cls.id > last.id),
+                    )
+                )
+            rows = page.limit(batch_size).all()
+            for row in rows:
+                yield row.vote_count, row.caption
+            if len(rows) < batch_size:
+                return
+            last = rows[-1]
+
+    @classmethod
+    def get_captions_and_votes(cls, db, round_id):
+        query = db.query(cls.vote_count, cls.caption)
+        return query.filter(cls.round_id == round_id).all()
+
+    @classmethod
+    def rebuild_vote_counts(cls, db):
+        """
+        Recompute vote_count from the votes table
+
+        Returns the number of captions whose count was wrong.
+
+        """
+        count = select([func.count(Vote.user)]).where(Vote.caption_id == cls.id)
+        actual = count.as_scalar()
+        return (
+            db.query(cls)
+            .filter(cls.vote_count != actual)
+            .update({cls.vote_count: actual}, synchronize_session=False)
+        )
+
+    @classmethod
+    def get_votes(cls, db, user, round_id):
         return (
             db.query(cls)
             .join(Vote.caption)
-            .filter(cls.channel == channel)
+            .filter(Vote.round_id == round_id)
             .filter(Vote.user == user)
         )
 
@@ -180,20 +669,630 @@ class Vote(Base):
     __tablename__ = "votes"
     user = Column(String(20), primary_key=True)
     caption_id = Column(
-        Integer, ForeignKey(Caption.id, ondelete="CASCADE"), primary_key=True
+        Integer,
+        ForeignKey(Caption.id, ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
     )
+    round_id = Column(Integer, index=True)
 
     caption = relationship(
         "Caption", backref=backref("votes", cascade="all, delete-orphan")
     )
 
     @classmethod
-    def toggle_vote(cls, db, user, caption):
-        vote = db.query(cls).get((user, caption))
-        if vote is None:
-            db.add(cls(user=user, caption_id=caption))
-        else:
-            db.delete(vote)
+    def toggle_vote(cls, db, user, caption, round_id):
+        """
+        Add the vote if it doesn't exist, remove it if it does
+
+        Keeps Caption.vote_count up to date. Returns True if the vote was
+        added.
+
+        """
+        removed = (
+            db.query(cls)
+            .filter(cls.user == user, cls.caption_id == caption)
+            .delete(synchronize_session=False)
+        )
+        if not removed:
+            db.add(cls(user=user, caption_id=caption, round_id=round_id))
+        db.query(Caption).filter(Caption.id == caption).update(
+            {Caption.vote_count: Caption.vote_count + (-1 if removed else 1)},
+            synchronize_session=False,
+        )
+        return not removed
+
+
+class RoundArchive(Base):
+
+    """
+    The results of a finished round, which outlive its captions and votes
+
+    Rows are only ever added. The results are stored as zlib-compressed
+    JSON, see :meth:`get_results`.
+
+    """
+
+    __tablename__ = "round_archive"
+    round_id = Column(Integer, primary_key=True)
+    team_id = Column(String(20), nullable=False)
+    channel = Column(String(20), nullable=False)
+    ended = Column(DateTime, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+    @classmethod
+    def add(cls, db, config, results):
+        data = zlib.compress(jsoncodec.dumps(results).encode("utf-8"))
+        db.add(
+            cls(
+                round_id=config.round_id,
+                team_id=config.team_id,
+                channel=config.channel,
+                ended=datetime.utcnow(),
+                data=data,
+            )
+        )
+
+    @classmethod
+    def get_results(cls, db, round_id):
+        """ Get the results dict of an archived round, or None """
+        data = db.query(cls.data).filter(cls.round_id == round_id).scalar()
+        if data is None:
+            return None
+        return jsoncodec.loads(zlib.decompress(data).decode("utf-8"))
+
+
+class ChannelStats(Base):
+
+    """ Running totals for a channel, updated as each round ends """
+
+    __tablename__ = "channel_stats"
+    team_id = Column(String(20), primary_key=True)
+    channel = Column(String(20), primary_key=True)
+    rounds = Column(Integer, nullable=False)
+    captions = Column(Integer, nullable=False)
+    votes = Column(Integer, nullable=False)
+
+    @classmethod
+    def get(cls, db, team_id, channel):
+        return db.query(cls).get((team_id, channel))
+
+    @classmethod
+    def add_round(cls, db, team_id, channel, captions, votes):
+        stats = cls.get(db, team_id, channel)
+        if stats is None:
+            stats = cls(team_id=team_id, channel=channel, rounds=0, captions=0, votes=0)
+            db.add(stats)
+        stats.rounds += 1
+        stats.captions += captions
+        stats.votes += votes
+
+
+class UserStats(Base):
+
+    """ Running totals for a user in a channel, updated as each round ends """
+
+    __tablename__ = "user_stats"
+    team_id = Column(String(20), primary_key=True)
+    channel = Column(String(20), primary_key=True)
+    user = Column(String(20), primary_key=True)
+    # Rounds the user submitted a caption to or voted in
+    rounds = Column(Integer, nullable=False)
+    captions = Column(Integer, nullable=False)
+    # Votes received by the user's captions
+    votes = Column(Integer, nullable=False)
+    wins = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_user_stats_leaderboard", "team_id", "channel", "wins", "votes"),
+    )
+
+    @classmethod
+    def add_round(cls, db, team_id, channel, totals, batch_size=500):
+        """
+        Add one round to the users' totals
+
+        Parameters
+        ----------
+        totals : dict
+            Map of user to (captions, votes, wins) for the round
+
+        """
+        users = list(totals)
+        for start in range(0, len(users), batch_size):
+            batch = users[start : start + batch_size]
+            query = db.query(cls).filter(
+                cls.team_id == team_id, cls.channel == channel, cls.user.in_(batch)
+            )
+            existing = dict((stats.user, stats) for stats in query)
+            for user in batch:
+                stats = existing.get(user)
+                if stats is None:
+                    stats = cls(
+                        team_id=team_id,
+                        channel=channel,
+                        user=user,
+                        rounds=0,
+                        captions=0,
+                        votes=0,
+                        wins=0,
+                    )
+                    db.add(stats)
+                captions, votes, wins = totals[user]
+                stats.rounds += 1
+                stats.captions += captions
+                stats.votes += votes
+                stats.wins += wins
+
+    @classmethod
+    def get_top(cls, db, team_id, channel, limit=10):
+        """ Get the users with the most wins (then votes) in a channel """
+        return (
+            db.query(cls)
+            .filter(cls.team_id == team_id, cls.channel == channel)
+            .order_by(cls.wins.desc(), cls.votes.desc())
+            .limit(limit)
+            .all()
+        )
+
+
+class Image(Base):
+
+    """ A Slack file that was downloaded to the image store """
+
+    __tablename__ = "images"
+    team_id = Column(String(20), primary_key=True)
+    file_id = Column(String(20), primary_key=True)
+    # "<sha256 of the original>.<ext>" in the images.directory
+    filename = Column(String(80), nullable=False, index=True)
+    created = Column(DateTime, nullable=False)
+
+    @classmethod
+    def get_filename(cls, db, team_id, file_id):
+        query = db.query(cls.filename).filter(
+            cls.team_id == team_id, cls.file_id == file_id
+        )
+        return query.scalar()
+
+    @classmethod
+    def add(cls, db, team_id, file_id, filename):
+        db.merge(
+            cls(
+                team_id=team_id,
+                file_id=file_id,
+                filename=filename,
+                created=datetime.utcnow(),
+            )
+        )
+
+
+class Delivery(Base):
+
+    """ A Slack event or interaction that was handled, and its response """
+
+    __tablename__ = "deliveries"
+    key = Column(String(150), primary_key=True)
+    created = Column(DateTime, nullable=False, index=True)
+    # BATCHED for a caption written by the caption batcher, whose response
+    # isn't kept
+    status = Column(Integer, nullable=False)
+    content_type = Column(String(100))
+    body = Column(UnicodeText, nullable=False)
+
+    BATCHED = 0
+
+    @classmethod
+    def get_response(cls, db, key):
+        """ Get the (status, content_type, body) sent for a delivery, or None """
+        row = (
+            db.query(cls.status, cls.content_type, cls.body)
+            .filter(cls.key == key, cls.status != cls.BATCHED)
+            .first()
+        )
+        return None if row is None else tuple(row)
+
+    @classmethod
+    def get_keys(cls, db, keys):
+        """ Get the set of the given delivery keys that were already handled """
+        if not keys:
+            return set()
+        return set(row[0] for row in db.query(cls.key).filter(cls.key.in_(keys)))
+
+    @classmethod
+    def record(cls, db, key, status, content_type, body):
+        """
+        Save the response to a delivery
+
+        Committed with the changes made by the handler, so if a retry was
+        handled at the same time, one of the two fails on the primary key.
+
+        """
+        db.add(
+            cls(
+                key=key,
+                created=datetime.utcnow(),
+                status=status,
+                content_type=content_type,
+                body=body,
+            )
+        )
+
+    @classmethod
+    def record_batched(cls, db, keys):
+        """ Save the deliveries of captions written by the caption batcher """
+        if keys:
+            now = datetime.utcnow()
+            rows = [
+                {"key": key, "created": now, "status": cls.BATCHED, "body": ""}
+                for key in keys
+            ]
+            db.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def prune(cls, db, before):
+        """ Delete the deliveries recorded before a datetime """
+        query = db.query(cls).filter(cls.created < before)
+        return query.delete(synchronize_session=False)
+
+
+class Outbox(Base):
+
+    """ Slack API calls waiting to be sent after the request has returned """
+
+    __tablename__ = "outbox"
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    team_id = Column(String(20), nullable=False, server_default="")
+    channel = Column(String(20), index=True, nullable=False)
+    path = Column(String(50), nullable=False)
+    body = Column(JSONEncodedDict(), nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    locked_until = Column(DateTime)
+    key = Column(String(100), index=True)
+    send_after = Column(DateTime)
+
+    @classmethod
+    def enqueue(cls, db, team_id, channel, path, body, key=None, delay=0):
+        """
+        Queue a Slack API call
+
+        If ``key`` is given, the call replaces any unsent call with the same
+        key, and it is held for ``delay`` seconds so that a burst of updates
+        results in a single call with the latest state.
+
+        """
+        send_after = None
+        if delay:
+            send_after = datetime.utcnow() + timedelta(seconds=delay)
+        if key is not None:
+            now = datetime.utcnow()
+            replaced = (
+                db.query(cls)
+                .filter(cls.key == key)
+                .filter(or_(cls.locked_until.is_(None), cls.locked_until <= now))
+                .update(
+                    {cls.path: path, cls.body: body, cls.send_after: send_after},
+                    synchronize_session=False,
+                )
+            )
+            if replaced:
+                return
+        db.add(
+            cls(
+                team_id=team_id,
+                channel=channel,
+                path=path,
+                body=body,
+                key=key,
+                send_after=send_after,
+            )
+        )
+
+    @classmethod
+    def claim(cls, db, lease, skip_paths=()):
+        """
+        Lock the next message that is ready to send
+
+        Only the oldest message for each channel (or for each key, if it has
+        one) can be claimed, so messages are sent in the order they were
+        queued. Messages to ``skip_paths`` are left alone. Returns None if
+        nothing is ready.
+
+        """
+        while True:
+            now = datetime.utcnow()
+            heads = db.query(func.min(cls.id)).group_by(
+                func.coalesce(cls.key, cls.channel)
+            )
+            query = (
+                db.query(cls)
+                .filter(cls.id.in_(heads))
+                .filter(or_(cls.locked_until.is_(None), cls.locked_until <= now))
+                .filter(or_(cls.send_after.is_(None), cls.send_after <= now))
+            )
+            if skip_paths:
+                query = query.filter(cls.path.notin_(skip_paths))
+            msg = query.order_by(cls.id).first()
+            if msg is None:
+                db.rollback()
+                return None
+            # Another worker may have claimed it since we read it
+            claimed = (
+                db.query(cls)
+                .filter(cls.id == msg.id)
+                .filter(or_(cls.locked_until.is_(None), cls.locked_until <= now))
+                .update(
+                    {cls.locked_until: now + timedelta(seconds=lease)},
+                    synchronize_session=False,
+                )
+            )
+            db.commit()
+            if claimed:
+                return msg
+
+    @classmethod
+    def count_path(cls, db, path):
+        """ Count the queued calls to one path """
+        return db.query(func.count(cls.id)).filter(cls.path == path).scalar()
+
+    @classmethod
+    def complete(cls, db, msg):
+        db.query(cls).filter(cls.id == msg.id).delete(synchronize_session=False)
+        db.commit()
+
+    @classmethod
+    def retry(cls, db, msg, delay):
+        db.query(cls).filter(cls.id == msg.id).update(
+            {
+                cls.attempts: cls.attempts + 1,
+                cls.locked_until: datetime.utcnow() + timedelta(seconds=delay),
+            },
+            synchronize_session=False,
+        )
+        db.commit()
+
+
+def _add_column(conn, column):
+    """ Add a column (and any index on it) to an existing table """
+    table = column.table
+    LOG.info("Adding column %s.%s", table.name, column.name)
+    ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (
+        table.name,
+        conn.dialect.identifier_preparer.quote(column.name),
+        column.type.compile(dialect=conn.dialect),
+    )
+    if not column.nullable:
+        ddl += " NOT NULL"
+    if column.server_default is not None:
+        ddl += " DEFAULT '%s'" % column.server_default.arg
+    conn.execute(ddl)
+    for index in table.indexes:
+        if column in index.columns.values():
+            index.create(conn)
+
+
+def _migrate_config_columns(conn):
+    """ Move contest state and deadline out of the Config JSON blob """
+    _add_column(conn, Config.__table__.c.state)
+    _add_column(conn, Config.__table__.c.end_dt)
+    rows = conn.execute(text("SELECT channel, value FROM configs")).fetchall()
+    for channel, raw in rows:
+        value = json.loads(raw)
+        state = value.pop("state", None)
+        end = value.pop("end", None)
+        end_dt = None if end is None else datetime.utcfromtimestamp(end)
+        conn.execute(
+            text(
+                "UPDATE configs SET state = :state, end_dt = :end_dt, value = :value "
+                "WHERE channel = :channel"
+            ).bindparams(
+                bindparam("end_dt", end_dt, type_=DateTime),
+                state=state,
+                value=json.dumps(value),
+                channel=channel,
+            )
+        )
+
+
+def _migrate_vote_counts(conn):
+    """ Add the denormalized Caption.vote_count and fill it in """
+    _add_column(conn, Caption.__table__.c.vote_count)
+    for index in Vote.__table__.indexes:
+        if Vote.__table__.c.caption_id in index.columns.values():
+            index.create(conn)
+    conn.execute(
+        "UPDATE captions SET vote_count = "
+        "(SELECT COUNT(*) FROM votes WHERE votes.caption_id = captions.id)"
+    )
+
+
+def _migrate_outbox_coalescing(conn):
+    _add_column(conn, Outbox.__table__.c.key)
+    _add_column(conn, Outbox.__table__.c.send_after)
+
+
+def _migrate_teams(conn, team_id):
+    """ Scope contests, captions and queued calls to a Slack team """
+    # The configs primary key changes, so the table has to be rebuilt
+    for index in inspect(conn).get_indexes("configs"):
+        conn.execute("DROP INDEX %s" % index["name"])
+    conn.execute("ALTER TABLE configs RENAME TO configs_old")
+    if conn.dialect.name == "postgresql":
+        # Index names are per schema, and the new table needs this one
+        conn.execute("ALTER INDEX configs_pkey RENAME TO configs_old_pkey")
+    Config.__table__.create(conn)
+    conn.execute(
+        text(
+            "INSERT INTO configs (team_id, channel, state, end_dt, shard_key, value) "
+            "SELECT :team_id, channel, state, end_dt, :shard_key, value "
+            "FROM configs_old"
+        ),
+        team_id=team_id,
+        shard_key=team_shard_key(team_id),
+    )
+    conn.execute("DROP TABLE configs_old")
+    inspector = inspect(conn)
+    for table in (Caption.__table__, Outbox.__table__):
+        # The outbox may have just been created with the new schema
+        columns = set(col["name"] for col in inspector.get_columns(table.name))
+        if "team_id" not in columns:
+            _add_column(conn, table.c.team_id)
+        conn.execute(table.update().values(team_id=team_id))
+
+
+def _migrate_rounds(conn):
+    """ Put the captions and votes of running contests in a round """
+    inspector = inspect(conn)
+    for table in (Config.__table__, Caption.__table__, Vote.__table__):
+        # configs may have just been rebuilt with the new schema
+        columns = set(col["name"] for col in inspector.get_columns(table.name))
+        if "round_id" not in columns:
+            _add_column(conn, table.c.round_id)
+    configs = conn.execute(
+        select([Config.team_id, Config.channel]).where(Config.state.isnot(None))
+    ).fetchall()
+    for team_id, channel in configs:
+        result = conn.execute(
+            Round.__table__.insert().values(
+                team_id=team_id, channel=channel, started=datetime.utcnow()
+            )
+        )
+        round_id = result.inserted_primary_key[0]
+        for table in (Config.__table__, Caption.__table__):
+            conn.execute(
+                table.update()
+                .where(and_(table.c.team_id == team_id, table.c.channel == channel))
+                .values(round_id=round_id)
+            )
+    conn.execute(
+        "UPDATE votes SET round_id = "
+        "(SELECT round_id FROM captions WHERE captions.id = votes.caption_id)"
+    )
+
+
+def _migrate_config_leases(conn):
+    inspector = inspect(conn)
+    # configs may have just been rebuilt with the new schema
+    columns = set(col["name"] for col in inspector.get_columns("configs"))
+    for column in (Config.__table__.c.lease_owner, Config.__table__.c.locked_until):
+        if column.name not in columns:
+            _add_column(conn, column)
+
+
+def migrate(engine, team_id=""):
+    """
+    Upgrade tables created by older versions of the schema
+
+    Parameters
+    ----------
+    engine : :class:`sqlalchemy.engine.Engine`
+    team_id : str, optional
+        Existing contests from before multi-workspace support are assigned
+        to this Slack team
+
+    """
+    inspector = inspect(engine)
+
+    def columns(table):
+        return set(col["name"] for col in inspector.get_columns(table))
+
+    config_columns = columns("configs")
+    caption_columns = columns("captions")
+    outbox_columns = columns("outbox")
+    with engine.begin() as conn:
+        if "end_dt" not in config_columns:
+            _migrate_config_columns(conn)
+        if "vote_count" not in caption_columns:
+            _migrate_vote_counts(conn)
+        if "send_after" not in outbox_columns:
+            _migrate_outbox_coalescing(conn)
+        if "team_id" not in config_columns:
+            _migrate_teams(conn, team_id)
+        if "round_id" not in caption_columns:
+            _migrate_rounds(conn)
+        if "user" not in caption_columns:
+            _add_column(conn, Caption.__table__.c.user)
+        if "locked_until" not in config_columns:
+            _migrate_config_leases(conn)
+
+
+def get_sqlite_pragmas(settings):
+    """
+    Get the PRAGMAs for new SQLite connections
+
+    Starts from the ``sqlite.profile`` in :data:`SQLITE_PROFILES` (default
+    "safe") and applies any ``sqlite.pragma.<name>`` overrides.
+
+    """
+    pragmas = dict(SQLITE_PROFILES[settings.get("sqlite.profile", "safe")])
+    for key, value in settings.items():
+        if key.startswith("sqlite.pragma."):
+            pragmas[key[len("sqlite.pragma.") :]] = value
+    return pragmas
+
+
+def _sqlite_connect_listener(pragmas):
+    def set_pragmas(dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+    return set_pragmas
+
+
+def create_engine(settings):
+    """ Create the engine from the ``db.`` settings """
+    kwargs = {}
+    url = make_url(settings["db.url"])
+    is_sqlite = url.get_backend_name() == "sqlite"
+    if is_sqlite and url.database not in (None, "", ":memory:"):
+        if settings.get("sqlite.profile") == "production":
+            # Keep connections open, along with their page cache and mmap,
+            # instead of reconnecting on every checkout
+            kwargs["poolclass"] = QueuePool
+            kwargs["connect_args"] = {"check_same_thread": False}
+    elif not is_sqlite:
+        # Drop connections that the database server closed while idle
+        kwargs["pool_pre_ping"] = True
+    engine = engine_from_config(settings, prefix="db.", **kwargs)
+    if is_sqlite:
+        listener = _sqlite_connect_listener(get_sqlite_pragmas(settings))
+        event.listen(engine, "connect", listener)
+    return engine
+
+
+@contextmanager
+def lock_timeout(conn, seconds):
+    """
+    Make a connection give up waiting for a lock after ``seconds``
+
+    The previous timeout is put back before the connection goes back to the
+    pool.
+
+    """
+    millis = int(seconds * 1000)
+    if conn.dialect.name == "sqlite":
+        previous = conn.execute("PRAGMA busy_timeout").scalar()
+        reset = "PRAGMA busy_timeout = %d" % previous
+        conn.execute("PRAGMA busy_timeout = %d" % millis)
+    elif conn.dialect.name == "postgresql":
+        # Outside of a transaction, so a rollback doesn't undo the reset
+        conn = conn.execution_options(autocommit=True)
+        reset = "RESET lock_timeout"
+        conn.execute("SET lock_timeout = %d" % millis)
+    else:
+        yield
+        return
+    try:
+        yield
+    finally:
+        conn.execute(reset)
+
+
+def init_schema(engine, team_id=""):
+    """ Create any missing tables and run the migrations """
+    Base.metadata.create_all(bind=engine)
+    migrate(engine, team_id)
 
 
 def get_db(request):
@@ -205,12 +1304,17 @@ def get_db(request):
 def includeme(config):
     settings = config.get_settings()
 
-    engine = engine_from_config(
-        settings, prefix="db.", listeners=[ForeignKeysListener()]
+    engine = create_engine(settings)
+    # Deployments run captionary-migrate instead of paying for this on every
+    # startup
+    if asbool(settings.get("schema.auto_migrate", False)):
+        init_schema(engine, settings.get("slack.team_id", ""))
+    config.registry.state_cache = create_state_cache(settings)
+    config.registry.dbmaker = sessionmaker(
+        bind=engine, info={"state_cache": config.registry.state_cache}
     )
-    # Create SQL schema if not exists
-    Base.metadata.create_all(bind=engine)
-    config.registry.dbmaker = sessionmaker(bind=engine)
+    event.listen(config.registry.dbmaker, "after_commit", _after_commit)
+    event.listen(config.registry.dbmaker, "after_rollback", _after_rollback)
 
     config.add_request_method(get_db, name="db", reify=True)
 
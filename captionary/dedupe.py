@@ -0,0 +1,184 @@
+"""
+Answer Slack's retried deliveries without handling them twice
+
+Slack re-sends an event (with an ``X-Slack-Retry-Num`` header) when we are
+slow to reply, and a retried vote would toggle the vote back off. Each
+delivery is identified by the event's ``event_id``, or the ``trigger_id`` of
+a slash command or interaction.
+
+The response to a delivery is saved in the deliveries table in the same
+transaction as the handler's changes, and kept in a bounded in-memory LRU, so
+a later repeat is answered with the original response. The table is only
+read for a retry, so it costs a first delivery no more than an insert into
+a commit that was happening anyway. A retry that is
+handled at the same time as the original fails on the table's primary key
+when it commits, so only one of them takes effect. With
+``captions.write_behind`` a caption is committed by the caption batcher
+instead of the request, so the batcher saves the delivery along with the
+caption, and skips a submission whose delivery it has already saved.
+
+Settings: ``dedupe.cache_size`` (entries, default 10000) and ``dedupe.ttl``
+(seconds to remember a delivery, default 3600).
+
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pyramid.response import Response
+from .db import Delivery
+
+LOG = logging.getLogger(__name__)
+# Environ key of the delivery that the view should record
+DELIVERY_KEY = "captionary.delivery_key"
+
+
+class DeliveryCache(object):
+
+    """
+    LRU of recent delivery responses, each of which expires after ``ttl``
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of entries
+    ttl : float
+        Seconds to keep an entry
+
+    """
+
+    def __init__(self, size=10000, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._next_prune = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def add_duplicate(self):
+        with self._lock:
+            self.duplicates += 1
+
+    def prune_due(self):
+        """ True at most once every tenth of the ttl, to clean up the table """
+        now = time.time()
+        with self._lock:
+            if now < self._next_prune:
+                return False
+            self._next_prune = now + self.ttl / 10
+            return True
+
+
+def delivery_key(request):
+    """ Get the id of a Slack delivery, or None if it doesn't have one """
+    if request.content_type == "application/json":
+        kind, delivery_id = "event", request.json_body.get("event_id")
+    elif "payload" in request.POST:
+        payload = json.loads(request.POST["payload"])
+        kind, delivery_id = "action", payload.get("trigger_id")
+    else:
+        kind, delivery_id = "command", request.POST.get("trigger_id")
+    if not delivery_id:
+        return None
+    return "%s:%s:%s" % (kind, request.team_id, delivery_id)
+
+
+def _replay(request, key, response):
+    status, content_type, body = response
+    LOG.info(
+        "Answering duplicate delivery %s (retry %s)",
+        key,
+        request.headers.get("X-Slack-Retry-Num", "-"),
+    )
+    request.registry.deliveries.add_duplicate()
+    return Response(
+        body=body.encode("utf-8"),
+        status=status,
+        content_type=content_type,
+        charset="utf-8",
+    )
+
+
+def take_delivery(request):
+    """
+    Take over saving the request's delivery, for a write made outside of the
+    request's transaction
+
+    Returns the delivery key, or None if there is none to save.
+
+    """
+    return request.environ.pop(DELIVERY_KEY, None)
+
+
+def idempotent(view):
+    """
+    View decorator that handles each Slack delivery only once
+
+    Use it as the ``decorator`` of a :func:`~pyramid.view.view_config`, so it
+    sees the rendered response.
+
+    """
+
+    def wrapper(context, request):
+        key = delivery_key(request)
+        if key is None:
+            return view(context, request)
+        cache = request.registry.deliveries
+        response = cache.get(key)
+        if response is not None:
+            return _replay(request, key, response)
+        # Only a retry can have been recorded by another process. Looking
+        # for the others too would hold a connection for every request.
+        if "X-Slack-Retry-Num" in request.headers:
+            response = Delivery.get_response(request.db, key)
+            if response is not None:
+                cache.set(key, response)
+                return _replay(request, key, response)
+
+        def finish(success):
+            if success:
+                cache.set(key, response)
+
+        request.environ[DELIVERY_KEY] = key
+        request.tm.get().addAfterCommitHook(finish)
+        result = view(context, request)
+        response = (
+            result.status_code,
+            result.content_type,
+            result.body.decode(result.charset or "utf-8", "replace"),
+        )
+        if take_delivery(request) is not None:
+            Delivery.record(request.db, key, *response)
+        if cache.prune_due():
+            Delivery.prune(request.db, datetime.utcnow() - timedelta(seconds=cache.ttl))
+        return result
+
+    return wrapper
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.deliveries = DeliveryCache(
+        int(settings.get("dedupe.cache_size", 10000)),
+        float(settings.get("dedupe.ttl", 3600)),
+    )
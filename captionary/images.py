@@ -0,0 +1,276 @@
+"""
+Local copies of contest images
+
+When ``images.directory`` is set, the image that starts a contest is
+downloaded once with the team's bot token, shrunk to a thumbnail (if Pillow
+is installed) and saved under the sha256 of its content. The download is a
+job in the outbox, so the ``/event`` webhook only records the Slack file on
+the round. Once the copy is stored, the ballot and results link to it on our
+own ``/images/`` route instead of the private file url. A file is only
+downloaded once, and files with the same content share one copy.
+
+Slack doesn't tell us what is in a new file until it is downloaded, which is
+after its contest has started. So when a contest starts, the picture of the
+running contest is only recognized if the new file was stored before.
+
+The images come from private files, so each url carries an expiry and an
+HMAC of the file name and expiry made with ``images.secret``. Links are good
+for ``images.url_ttl`` seconds (default 30 days). The scheduler posts the
+ballot and results, so it needs ``images.base_url`` to build the links.
+Without a stored copy or a base url the messages have no image, because
+Slack can't show its own private file url in them.
+
+"""
+import hashlib
+import hmac
+import io
+import logging
+import os
+import re
+import tempfile
+import time
+from urllib.parse import urlencode
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import FileResponse
+from .db import Config, Image
+from .metrics import record_slack_call
+from .slack import SlackException
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+LOG = logging.getLogger(__name__)
+
+# Slack filetype to the extension of the stored file
+EXTENSIONS = {"png": "png", "jpg": "jpg", "jpeg": "jpg", "gif": "gif"}
+FILENAME = re.compile(r"^[0-9a-f]{64}\.(png|jpg|gif)$")
+MAX_BYTES = 20 * 1024 * 1024
+URL_TTL = 30 * 24 * 60 * 60
+# Outbox path of the job that downloads a contest image
+DOWNLOAD_JOB = "captionary.images.download"
+
+
+def make_thumbnail(data, max_size):
+    """ Shrink an image to fit in max_size x max_size, in the same format """
+    if PILImage is None:
+        return data
+    try:
+        image = PILImage.open(io.BytesIO(data))
+        if image.width <= max_size and image.height <= max_size:
+            return data
+        image_format = image.format
+        image.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        image.save(output, format=image_format)
+    except (OSError, ValueError):
+        LOG.warning("Could not make a thumbnail; storing the original image")
+        return data
+    return output.getvalue()
+
+
+class ImageStore(object):
+
+    """
+    Directory of images named by content hash
+
+    Parameters
+    ----------
+    directory : str
+    max_size : int, optional
+        Largest width or height of a stored image (default 1024)
+    max_bytes : int, optional
+        Don't download files bigger than this (default 20MB)
+    secret : str
+        Key that signs the image urls
+    url_ttl : int, optional
+        Seconds that an image url is good for (default 30 days)
+    base_url : str, optional
+        Public url of the ``image`` route. Defaults to the route of the
+        request, if there is one.
+
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_size=1024,
+        max_bytes=MAX_BYTES,
+        secret=None,
+        url_ttl=URL_TTL,
+        base_url=None,
+    ):
+        if not secret:
+            raise ValueError("images.secret is required with images.directory")
+        self.directory = directory
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.secret = secret.encode("utf-8")
+        self.url_ttl = url_ttl
+        self.base_url = base_url
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def sign(self, filename, expires):
+        message = ("%s:%d" % (filename, expires)).encode("utf-8")
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def verify(self, filename, expires, signature):
+        """ True if the signature is ours and the url hasn't expired """
+        try:
+            expires = int(expires)
+        except ValueError:
+            return False
+        if expires <= time.time():
+            return False
+        return hmac.compare_digest(self.sign(filename, expires), signature)
+
+    def url(self, request, filename):
+        """ Get a signed url for an image, or None if there is no base url """
+        expires = int(time.time() + self.url_ttl)
+        query = {"expires": expires, "sig": self.sign(filename, expires)}
+        if self.base_url:
+            return "%s/%s?%s" % (self.base_url.rstrip("/"), filename, urlencode(query))
+        if not hasattr(request, "route_url"):
+            return None
+        return request.route_url("image", filename=filename, _query=query)
+
+    def save(self, data, filetype):
+        """ Store a thumbnail of an image and return its file name """
+        filename = "%s.%s" % (hashlib.sha256(data).hexdigest(), EXTENSIONS[filetype])
+        path = self.path(filename)
+        if os.path.exists(path):
+            return filename
+        # Write to a temporary file first so nobody serves a partial image
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as ofile:
+            ofile.write(make_thumbnail(data, self.max_size))
+        os.replace(tmp, path)
+        return filename
+
+
+def download(registry, team_id, url):
+    """ Download a private Slack file with the team's bot token """
+    store = registry.image_store
+    token = registry.slack_tokens.get(team_id)
+    start = time.perf_counter()
+    resp = registry.slack_session.get(
+        url,
+        headers={"Authorization": "Bearer " + token},
+        timeout=registry.slack_timeout,
+        stream=True,
+    )
+    try:
+        resp.raise_for_status()
+        data = resp.raw.read(store.max_bytes + 1, decode_content=True)
+    finally:
+        resp.close()
+    record_slack_call(registry, "files.download", time.perf_counter() - start)
+    if len(data) > store.max_bytes:
+        raise SlackException("File is larger than %d bytes" % store.max_bytes)
+    return data
+
+
+def stored_image(request, image):
+    """
+    Get the name of the stored copy of a Slack file, without downloading it
+
+    Parameters
+    ----------
+    request : :class:`pyramid.request.Request`
+    image : dict
+        The file object from the Slack event
+
+    Returns
+    -------
+    filename : str or None
+        None if the image store is disabled or the file isn't stored yet
+
+    """
+    store = request.registry.image_store
+    if store is None:
+        return None
+    filename = Image.get_filename(request.db, request.team_id, image["id"])
+    if filename is not None and os.path.exists(store.path(filename)):
+        return filename
+    return None
+
+
+def queue_download(request, channel, image):
+    """ Queue a job that stores a contest's image once the request commits """
+    if request.registry.image_store is None or image["filetype"] not in EXTENSIONS:
+        return
+    # Its own key, so the channel's messages don't wait for the download
+    key = "image:%s:%s" % (request.team_id, channel)
+    request.outbox.coalesced(key, 0).call(
+        DOWNLOAD_JOB,
+        {
+            "channel": channel,
+            "file_id": image["id"],
+            "url": image["url_private"],
+            "filetype": image["filetype"],
+        },
+    )
+
+
+def download_job(registry, db, team_id, body):
+    """ Outbox job that downloads a contest image and links the contest to it """
+    filename = Image.get_filename(db, team_id, body["file_id"])
+    if filename is None or not os.path.exists(registry.image_store.path(filename)):
+        data = download(registry, team_id, body["url"])
+        filename = registry.image_store.save(data, body["filetype"])
+        Image.add(db, team_id, body["file_id"], filename)
+    Config.set_image_file(db, team_id, body["channel"], body["file_id"], filename)
+
+
+def contest_image_url(request, config):
+    """
+    Get a public url of a contest's image for the ballot and results
+
+    Returns None if there is no stored copy to link to. Slack can't fetch
+    the private file url, and rejects a whole message with an image block
+    that it can't download.
+
+    """
+    store = request.registry.image_store
+    filename = config.value.get("image_file")
+    if store is None or filename is None:
+        return None
+    return store.url(request, filename)
+
+
+def image_view(request):
+    filename = request.matchdict["filename"]
+    store = request.registry.image_store
+    if not FILENAME.match(filename) or not store.verify(
+        filename, request.GET.get("expires", ""), request.GET.get("sig", "")
+    ):
+        return HTTPNotFound()
+    path = store.path(filename)
+    if not os.path.exists(path):
+        return HTTPNotFound()
+    max_age = int(request.GET["expires"]) - int(time.time())
+    return FileResponse(path, request=request, cache_max_age=max_age)
+
+
+def includeme(config):
+    settings = config.get_settings()
+    directory = settings.get("images.directory")
+    if not directory:
+        config.registry.image_store = None
+        return
+    config.registry.image_store = ImageStore(
+        directory,
+        int(settings.get("images.max_size", 1024)),
+        int(settings.get("images.max_bytes", MAX_BYTES)),
+        settings.get("images.secret"),
+        int(settings.get("images.url_ttl", URL_TTL)),
+        settings.get("images.base_url"),
+    )
+    config.registry.outbox_jobs[DOWNLOAD_JOB] = download_job
+    config.add_route("image", "/images/{filename}")
+    config.add_view(image_view, route_name="image")
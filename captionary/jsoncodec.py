@@ -0,0 +1,36 @@
+""" JSON encoding for database columns, using orjson if it is installed """
+import calendar
+import datetime
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def to_timestamp(dt):
+    """ Convert a naive UTC datetime to a unix timestamp """
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _default(obj):
+    # Matches the datetime adapter on the app's json renderer
+    if isinstance(obj, datetime.datetime):
+        return to_timestamp(obj)
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+if orjson is not None:
+
+    def dumps(value):
+        return orjson.dumps(
+            value, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME
+        ).decode("utf-8")
+
+    loads = orjson.loads
+
+else:
+    _ENCODER = json.JSONEncoder(separators=(",", ":"), default=_default)
+    dumps = _ENCODER.encode
+    loads = json.loads
@@ -0,0 +1,78 @@
+""" Archive finished rounds and keep the leaderboards up to date """
+from collections import defaultdict
+from .db import Caption, ChannelStats, RoundArchive, UserStats, Vote
+
+
+def archive_round(db, config):
+    """
+    Archive the results of a channel's current round and add them to the stats
+
+    Call this when voting ends, before :meth:`~captionary.db.Config.end_contest`.
+    The authors of the captions with the most votes each get a win.
+
+    """
+    if config.round_id is None:
+        return
+    captions = (
+        db.query(Caption.user, Caption.vote_count, Caption.caption)
+        .filter(Caption.round_id == config.round_id)
+        .order_by(Caption.vote_count.desc(), Caption.id)
+        .all()
+    )
+    voters = [
+        row[0]
+        for row in db.query(Vote.user)
+        .filter(Vote.round_id == config.round_id)
+        .distinct()
+    ]
+    best = captions[0].vote_count if captions else 0
+
+    # user -> [captions, votes received, wins]
+    totals = defaultdict(lambda: [0, 0, 0])
+    for caption in captions:
+        if caption.user is None:
+            continue
+        user_totals = totals[caption.user]
+        user_totals[0] += 1
+        user_totals[1] += caption.vote_count
+        if best > 0 and caption.vote_count == best:
+            user_totals[2] = 1
+    for voter in voters:
+        # Voting counts as taking part in the round
+        if voter not in totals:
+            totals[voter] = [0, 0, 0]
+
+    votes = sum(caption.vote_count for caption in captions)
+    UserStats.add_round(db, config.team_id, config.channel, totals)
+    ChannelStats.add_round(db, config.team_id, config.channel, len(captions), votes)
+    RoundArchive.add(
+        db,
+        config,
+        {
+            "file_id": config.value.get("file_id"),
+            "image_url": config.value.get("image_url"),
+            # [caption, user, votes] with the most votes first
+            "captions": [
+                [caption.caption, caption.user, caption.vote_count]
+                for caption in captions
+            ],
+            "voters": len(voters),
+        },
+    )
+
+
+def leaderboard_text(db, team_id, channel, limit=10):
+    """ Format the channel's leaderboard from the precomputed stats """
+    stats = ChannelStats.get(db, team_id, channel)
+    if stats is None:
+        return "No contests have finished in this channel yet"
+    lines = [
+        "*Leaderboard* (%d contests, %d captions, %d votes)"
+        % (stats.rounds, stats.captions, stats.votes)
+    ]
+    for rank, user in enumerate(UserStats.get_top(db, team_id, channel, limit), 1):
+        lines.append(
+            "%d. <@%s> - %d wins, %d votes on %d captions, played %d"
+            % (rank, user.user, user.wins, user.votes, user.captions, user.rounds)
+        )
+    return "\n".join(lines)
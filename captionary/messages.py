@@ -0,0 +1,127 @@
+""" Build the ballot and results as one or more Block Kit messages """
+import math
+import random
+from .db import Caption
+from .util import format_timedelta
+
+# Slack rejects messages with more than 50 blocks
+CAPTIONS_PER_PAGE = 45
+# Maximum length of the text in a section block
+SECTION_LIMIT = 3000
+# Keep each results message well under Slack's 40k character limit
+SECTIONS_PER_MESSAGE = 10
+
+
+def ballot_timestamps(config):
+    """ Get the timestamps of every message in a channel's ballot """
+    message_ts = config.value.get("message_ts")
+    if message_ts is None:
+        return []
+    # Contests started by older versions posted a single message
+    if not isinstance(message_ts, list):
+        return [message_ts]
+    return message_ts
+
+
+def _truncate(text, limit=SECTION_LIMIT):
+    if len(text) <= limit:
+        return text
+    return text[: limit - 1] + "…"
+
+
+def _section(text):
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
+
+def _image(image_url):
+    return {
+        "type": "image",
+        "image_url": image_url,
+        "alt_text": "Caption contest image",
+    }
+
+
+def ballot_messages(db, config, image_url, caption_ids, vote_duration):
+    """
+    Yield (text, blocks) for each page of the ballot
+
+    The captions are shuffled and loaded from the database one page at a
+    time. Each caption gets a vote button whose value is the caption id. The
+    first page shows the image if there is a public ``image_url``.
+
+    """
+    caption_ids = list(caption_ids)
+    random.shuffle(caption_ids)
+    pages = math.ceil(len(caption_ids) / CAPTIONS_PER_PAGE)
+    text = (
+        "Get out the vote! Polls are open for %s (or until next contest start)"
+        % format_timedelta(vote_duration)
+    )
+    for page in range(pages):
+        start = page * CAPTIONS_PER_PAGE
+        captions = Caption.get_captions_by_id(
+            db, caption_ids[start : start + CAPTIONS_PER_PAGE]
+        )
+        blocks = []
+        if page == 0:
+            blocks.append(_section(text))
+            if image_url is not None:
+                blocks.append(_image(image_url))
+        for caption in captions:
+            block = _section(_truncate(caption.caption))
+            block["block_id"] = "caption-%d" % caption.id
+            block["accessory"] = {
+                "type": "button",
+                "action_id": "vote",
+                "text": {"type": "plain_text", "text": "Vote"},
+                "value": str(caption.id),
+            }
+            blocks.append(block)
+        if pages == 1:
+            yield text, blocks
+            continue
+        label = "Page %d of %d" % (page + 1, pages)
+        blocks.append(
+            {"type": "context", "elements": [{"type": "mrkdwn", "text": label}]}
+        )
+        yield "%s (%s)" % (text, label.lower()), blocks
+
+
+def results_messages(db, config, image_url):
+    """
+    Yield (text, blocks) for each message of the results
+
+    Captions are streamed from the database with the most votes first, and
+    split into sections and messages that stay within Slack's limits. The
+    first message shows the image if there is a public ``image_url``.
+
+    """
+    title = "*Caption results:*"
+    sections = []
+    lines = []
+    length = 0
+    first = True
+
+    def message():
+        text = title if first else "*Caption results (continued):*"
+        blocks = [_section(text)]
+        if first and image_url is not None:
+            blocks.append(_image(image_url))
+        return text, blocks + [_section(section) for section in sections]
+
+    for votes, caption in Caption.iter_results(db, config.round_id):
+        line = caption if votes <= 0 else "%d - %s" % (votes, caption)
+        line = _truncate(line)
+        if lines and length + len(line) + 1 > SECTION_LIMIT:
+            sections.append("\n".join(lines))
+            lines, length = [], 0
+            if len(sections) >= SECTIONS_PER_MESSAGE:
+                yield message()
+                sections = []
+                first = False
+        lines.append(line)
+        length += len(line) + 1
+    if lines:
+        sections.append("\n".join(lines))
+    if sections or first:
+        yield message()
@@ -0,0 +1,236 @@
+""" Request timings, SQL query counts and Slack call latency """
+import logging
+import threading
+import time
+from collections import defaultdict
+from pyramid.response import Response
+from pyramid.settings import asbool
+from pyramid.tweens import INGRESS
+from sqlalchemy import event
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the request latency histogram buckets
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+_current = threading.local()
+
+
+class RequestStats(object):
+
+    """ Where the time went during one request """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.elapsed = 0
+        self.queries = 0
+        self.query_time = 0
+        self.slack_calls = defaultdict(int)
+        self.slack_time = defaultdict(float)
+
+    def breakdown(self):
+        """ Format the stats as key=value pairs for a log line """
+        parts = [
+            "elapsed=%.1fms" % (1000 * self.elapsed),
+            "queries=%d" % self.queries,
+            "query_time=%.1fms" % (1000 * self.query_time),
+        ]
+        for method in sorted(self.slack_calls):
+            parts.append(
+                "slack.%s=%d/%.1fms"
+                % (method, self.slack_calls[method], 1000 * self.slack_time[method])
+            )
+        return " ".join(parts)
+
+
+class Metrics(object):
+
+    """ Process-wide counters, rendered in the Prometheus text format """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.request_time = defaultdict(float)
+        self.request_buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self.queries = defaultdict(int)
+        self.query_time = defaultdict(float)
+        self.slack_calls = defaultdict(int)
+        self.slack_time = defaultdict(float)
+
+    def add_request(self, route, stats):
+        with self._lock:
+            self.requests[route] += 1
+            self.request_time[route] += stats.elapsed
+            buckets = self.request_buckets[route]
+            for i, bound in enumerate(BUCKETS):
+                if stats.elapsed <= bound:
+                    buckets[i] += 1
+            self.queries[route] += stats.queries
+            self.query_time[route] += stats.query_time
+
+    def add_slack_call(self, method, seconds):
+        with self._lock:
+            self.slack_calls[method] += 1
+            self.slack_time[method] += seconds
+
+    def render(self, gauges=None, counters=None):
+        """
+        Render all metrics as Prometheus text
+
+        Parameters
+        ----------
+        gauges : dict, optional
+            Additional gauges to include, mapping name to value
+        counters : dict, optional
+            Additional counters to include, mapping name to value
+
+        """
+        lines = []
+
+        def add(name, series, kind=None):
+            if kind is not None:
+                lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in series:
+                label = ",".join('%s="%s"' % pair for pair in labels)
+                lines.append("%s{%s} %s" % (name, label, value))
+
+        with self._lock:
+            routes = sorted(self.requests)
+            buckets = []
+            for route in routes:
+                counts = self.request_buckets[route] + [self.requests[route]]
+                for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                    buckets.append(((("route", route), ("le", bound)), count))
+            lines.append("# TYPE captionary_request_seconds histogram")
+            add("captionary_request_seconds_bucket", buckets)
+            add(
+                "captionary_request_seconds_sum",
+                [((("route", r),), self.request_time[r]) for r in routes],
+            )
+            add(
+                "captionary_request_seconds_count",
+                [((("route", r),), self.requests[r]) for r in routes],
+            )
+            add(
+                "captionary_request_queries_total",
+                [((("route", r),), self.queries[r]) for r in routes],
+                "counter",
+            )
+            add(
+                "captionary_request_query_seconds_total",
+                [((("route", r),), self.query_time[r]) for r in routes],
+                "counter",
+            )
+            methods = sorted(self.slack_calls)
+            add(
+                "captionary_slack_calls_total",
+                [((("method", m),), self.slack_calls[m]) for m in methods],
+                "counter",
+            )
+            add(
+                "captionary_slack_call_seconds_total",
+                [((("method", m),), self.slack_time[m]) for m in methods],
+                "counter",
+            )
+        for kind, values in (("gauge", gauges), ("counter", counters)):
+            for name, value in sorted((values or {}).items()):
+                lines.append("# TYPE %s %s" % (name, kind))
+                lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+def record_slack_call(registry, method, seconds):
+    """ Record the latency of one Slack API call """
+    stats = getattr(_current, "stats", None)
+    if stats is not None:
+        stats.slack_calls[method] += 1
+        stats.slack_time[method] += seconds
+    metrics = getattr(registry, "metrics", None)
+    if metrics is not None:
+        metrics.add_slack_call(method, seconds)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, *_):
+    conn.info.setdefault("query_start", []).append((context, time.perf_counter()))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, *_):
+    starts = conn.info.get("query_start")
+    if not starts or starts[-1][0] is not context:
+        # Started before the listeners were added (e.g. by an outbox worker)
+        return
+    elapsed = time.perf_counter() - starts.pop()[1]
+    stats = getattr(_current, "stats", None)
+    if stats is not None:
+        stats.queries += 1
+        stats.query_time += elapsed
+
+
+def _handle_error(exception_context):
+    # A failed query never reaches after_cursor_execute, so drop its start
+    # before the next query on the connection mistakes it for its own
+    conn = exception_context.connection
+    starts = conn.info.get("query_start") if conn is not None else None
+    if starts and starts[-1][0] is exception_context.execution_context:
+        starts.pop()
+
+
+def metrics_tween_factory(handler, registry):
+    metrics = registry.metrics
+    slow_request = float(registry.settings.get("metrics.slow_request", 1))
+
+    def metrics_tween(request):
+        stats = _current.stats = RequestStats()
+        try:
+            return handler(request)
+        finally:
+            _current.stats = None
+            stats.elapsed = time.perf_counter() - stats.start
+            route = getattr(request, "matched_route", None)
+            route_name = route.name if route is not None else "notfound"
+            metrics.add_request(route_name, stats)
+            if stats.elapsed >= slow_request:
+                LOG.warning("Slow request route=%s %s", route_name, stats.breakdown())
+
+    return metrics_tween
+
+
+def metrics_view(request):
+    stats = request.registry.slack_dispatcher.get_stats()
+    gauges = {"captionary_slack_queue_depth": stats.pop("queue_depth")}
+    counters = dict(
+        ("captionary_slack_%s_total" % key.replace(".", "_"), value)
+        for key, value in stats.items()
+    )
+    duplicates = request.registry.deliveries.duplicates
+    counters["captionary_duplicate_deliveries_total"] = duplicates
+    admission = request.registry.admission
+    if admission is not None:
+        stats = admission.get_stats()
+        gauges["captionary_admission_in_flight"] = stats.pop("in_flight")
+        gauges["captionary_admission_deferred_depth"] = stats.pop("deferred_depth")
+        for key, value in stats.items():
+            counters["captionary_admission_%s_total" % key] = value
+    text = request.registry.metrics.render(gauges, counters)
+    return Response(text, content_type="text/plain", charset="utf-8")
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.metrics = Metrics()
+    # Above pyramid_tm, so the timings and query counts include the flush and
+    # the commit
+    config.add_tween(
+        "captionary.metrics.metrics_tween_factory",
+        under=INGRESS,
+        over="pyramid_tm.tm_tween_factory",
+    )
+
+    engine = config.registry.dbmaker.kw["bind"]
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+    if asbool(settings.get("metrics.endpoint", False)):
+        config.add_route("metrics", "/metrics")
+        config.add_view(metrics_view, route_name="metrics")
@@ -0,0 +1,190 @@
+"""
+Durable queue of Slack API calls that are sent after the request commits
+
+Other modules can queue their own background work the same way, by adding a
+function to ``registry.outbox_jobs`` under a path that isn't a Slack method.
+It is called with ``(registry, db, team_id, body)``, and its changes are
+committed with the message's completion. If it raises, its changes are
+rolled back and it is retried like a Slack call that failed. A function in
+``registry.outbox_ready`` under the same path can hold the messages back: they
+aren't picked up while it returns False.
+
+"""
+import logging
+import threading
+import requests
+from .db import Outbox
+from .slack import SlackAPI, SlackException
+
+LOG = logging.getLogger(__name__)
+
+
+class QueuedSlackAPI(SlackAPI):
+
+    """
+    SlackAPI that writes each call to the outbox table instead of sending it
+
+    The calls are committed with the request's transaction and delivered by
+    the :class:`OutboxWorker` threads, so they never return a response.
+
+    """
+
+    def __init__(self, request, key=None, delay=0):
+        super(QueuedSlackAPI, self).__init__(request.registry, request.team_id)
+        self.request = request
+        self.key = key
+        self.delay = delay
+
+    def coalesced(self, key, delay=None):
+        """
+        Get a QueuedSlackAPI whose call replaces any unsent call with the same key
+
+        The call is held until no new call with that key has been made for
+        ``delay`` seconds (default ``outbox.coalesce_window``).
+
+        """
+        if delay is None:
+            delay = self.registry.outbox_coalesce_window
+        return QueuedSlackAPI(self.request, key, delay)
+
+    def call(self, path, body):
+        Outbox.enqueue(
+            self.request.db,
+            self.team_id,
+            body["channel"],
+            path,
+            body,
+            self.key,
+            self.delay,
+        )
+        wake = self.registry.outbox_wake
+
+        def wake_workers(success):
+            if success:
+                wake.set()
+
+        self.request.tm.get().addAfterCommitHook(wake_workers)
+
+
+class OutboxWorker(threading.Thread):
+
+    """
+    Thread that delivers queued Slack calls
+
+    Parameters
+    ----------
+    registry : :class:`pyramid.registry.Registry`
+    poll_interval : float
+        Check the table this often (seconds) even if nothing woke us up, to
+        pick up messages queued by other processes.
+    lease : float
+        How long (seconds) a claimed message is locked before another worker
+        is allowed to retry it.
+    max_attempts : int
+        Give up on a message after this many failed deliveries.
+
+    """
+
+    def __init__(self, registry, poll_interval=1, lease=60, max_attempts=5):
+        super(OutboxWorker, self).__init__()
+        self.daemon = True
+        self.registry = registry
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def run(self):
+        wake = self.registry.outbox_wake
+        while True:
+            try:
+                sent = self.send_next()
+            except Exception:  # pylint: disable=W0703
+                LOG.exception("Error processing outbox")
+                sent = False
+            if not sent:
+                wake.wait(self.poll_interval)
+                wake.clear()
+
+    def send_next(self):
+        db = self.registry.dbmaker()
+        try:
+            skip = [
+                path
+                for path, ready in self.registry.outbox_ready.items()
+                if not ready()
+            ]
+            msg = Outbox.claim(db, self.lease, skip)
+            if msg is None:
+                return False
+            job = self.registry.outbox_jobs.get(msg.path)
+            try:
+                if job is None:
+                    SlackAPI(self.registry, msg.team_id).call(msg.path, msg.body)
+                else:
+                    job(self.registry, db, msg.team_id, msg.body)
+            except SlackException:
+                # The API rejected the call; sending it again won't help
+                db.rollback()
+                Outbox.complete(db, msg)
+            except requests.RequestException as e:
+                db.rollback()
+                self._failed(db, msg, e)
+            except Exception as e:  # pylint: disable=W0703
+                # Left claimed, the message would hold up its channel forever
+                db.rollback()
+                LOG.exception("Error running %s for %s", msg.path, msg.channel)
+                self._failed(db, msg, e)
+            else:
+                Outbox.complete(db, msg)
+            return True
+        finally:
+            db.close()
+
+    def _failed(self, db, msg, error):
+        """ Send a message again later, or drop it after max_attempts """
+        if msg.attempts + 1 >= self.max_attempts:
+            LOG.error("Dropping %s to %s: %s", msg.path, msg.channel, error)
+            Outbox.complete(db, msg)
+        else:
+            LOG.warning("Error sending %s to %s: %s", msg.path, msg.channel, error)
+            Outbox.retry(db, msg, 2 ** msg.attempts)
+
+
+def flush_outbox(registry):
+    """ Send every queued message that is ready from the calling thread """
+    worker = OutboxWorker(registry)
+    while worker.send_next():
+        pass
+
+
+def start_workers(registry, settings):
+    count = int(settings.get("outbox.workers", 2))
+    for _ in range(count):
+        OutboxWorker(
+            registry,
+            float(settings.get("outbox.poll_interval", 1)),
+            float(settings.get("outbox.lease", 60)),
+            int(settings.get("outbox.max_attempts", 5)),
+        ).start()
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.outbox_wake = threading.Event()
+    config.registry.outbox_jobs = {}
+    config.registry.outbox_ready = {}
+    config.registry.outbox_coalesce_window = float(
+        settings.get("outbox.coalesce_window", 1.5)
+    )
+    config.add_request_method(QueuedSlackAPI, name="outbox", reify=True)
+
+    try:
+        from uwsgidecorators import postfork
+    except ImportError:
+        start_workers(config.registry, settings)
+    else:
+
+        @postfork
+        def run_postfork_hooks():
+            """ Threads don't survive the fork, so start them in each worker """
+            start_workers(config.registry, settings)
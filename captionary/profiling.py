@@ -0,0 +1,281 @@
+"""
+Sampling profiler for slow requests and scheduler ticks
+
+Set ``profiling.directory`` to enable it. A sampled fraction of requests
+(``profiling.sample_rate``, default 0) is profiled by a thread that records
+the stack of the request's thread every ``profiling.interval`` seconds. Each
+profile is written to the directory in the collapsed-stack format that
+``flamegraph.pl``, speedscope and inferno read.
+
+The rate can be changed without restarting any worker by writing it to the
+trigger file (``profiling.trigger``, default ``<directory>/enable``), for
+example ``echo 0.05 > /var/captionary-profiles/enable`` (an empty file
+profiles every request), and deleting the file to go back to the configured
+rate. Every process checks the file at most once a second. The scheduler
+profiles its next tick after a ``SIGUSR2``, and ``process_queue --profile``
+profiles a whole run.
+
+Request profiles are named after the matched route. Only the newest
+``profiling.max_files`` profiles (default 1000) are kept, and a profile that
+can't be written is logged and dropped without failing the request.
+
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pyramid.interfaces import IRoutesMapper
+from pyramid.tweens import INGRESS
+
+LOG = logging.getLogger(__name__)
+
+# Seconds between checks of the trigger file
+TRIGGER_CHECK_INTERVAL = 1
+# Longest name that goes into a profile's file name
+MAX_NAME = 50
+
+
+class Sampler(threading.Thread):
+
+    """
+    Thread that counts the stacks of other threads
+
+    Parameters
+    ----------
+    interval : float
+        Seconds between samples
+    thread_ids : list, optional
+        Only sample these threads. Defaults to every other thread.
+
+    """
+
+    def __init__(self, interval=0.005, thread_ids=None):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+        self._labels = {}
+        self._paths = sorted((path for path in sys.path if path), key=len, reverse=True)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            for path in self._paths:
+                if filename.startswith(path):
+                    filename = os.path.relpath(filename, path)
+                    break
+            label = "%s (%s:%d)" % (code.co_name, filename, code.co_firstlineno)
+            self._labels[code] = label
+        return label
+
+    def sample(self):
+        me = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            if self.thread_ids is not None and thread_id not in self.thread_ids:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path):
+        """ Write the stacks in the collapsed format, one per line """
+        with open(path, "w") as ofile:
+            for stack, count in self.stacks.most_common():
+                ofile.write("%s %d\n" % (stack, count))
+
+
+class Profiler(object):
+
+    """
+    Decides what to profile, and writes the profiles to a directory
+
+    Parameters
+    ----------
+    directory : str
+    sample_rate : float, optional
+        Fraction of requests to profile when there is no trigger file
+    interval : float, optional
+        Seconds between samples
+    trigger : str, optional
+        File that overrides ``sample_rate`` with the number it contains
+    max_files : int, optional
+        Delete the oldest profiles past this many (default 1000)
+
+    """
+
+    def __init__(
+        self, directory, sample_rate=0, interval=0.005, trigger=None, max_files=1000
+    ):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.trigger = trigger or os.path.join(directory, "enable")
+        self.max_files = max_files
+        self.tick_requested = False
+        self._rate = sample_rate
+        self._next_check = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def rate(self):
+        """ The current sample rate, from the trigger file if there is one """
+        now = time.monotonic()
+        if now < self._next_check:
+            return self._rate
+        self._next_check = now + TRIGGER_CHECK_INTERVAL
+        try:
+            with open(self.trigger, "r") as ifile:
+                self._rate = float(ifile.read().strip() or 1)
+        except FileNotFoundError:
+            self._rate = self.sample_rate
+        except (OSError, ValueError):
+            LOG.warning("Could not read a sample rate from %s", self.trigger)
+            self._rate = self.sample_rate
+        return self._rate
+
+    def should_profile(self):
+        rate = self.rate()
+        return rate > 0 and random.random() < rate
+
+    def request_tick(self, *_):
+        """ Profile the next scheduler tick (usable as a signal handler) """
+        self.tick_requested = True
+
+    def should_profile_tick(self):
+        if self.tick_requested:
+            self.tick_requested = False
+            return True
+        return self.should_profile()
+
+    @contextmanager
+    def profile(self, name, all_threads=False):
+        """
+        Sample the calling thread (or all threads) until the block exits
+
+        The profile is written to ``<name>-<timestamp>-<pid>.folded``, unless
+        the block finished before the first sample. Errors writing it are
+        logged, not raised.
+
+        """
+        thread_ids = None if all_threads else [threading.get_ident()]
+        sampler = Sampler(self.interval, thread_ids)
+        start = time.time()
+        sampler.start()
+        try:
+            yield sampler
+        finally:
+            sampler.stop()
+            elapsed = time.time() - start
+            if sampler.samples:
+                filename = "%s-%s.%06d-%d.folded" % (
+                    name[:MAX_NAME],
+                    time.strftime("%Y%m%dT%H%M%S", time.gmtime(start)),
+                    1e6 * (start % 1),
+                    os.getpid(),
+                )
+                if self._write(sampler, filename):
+                    LOG.info(
+                        "Wrote profile %s (%.1fms, %d samples)",
+                        filename,
+                        1000 * elapsed,
+                        sampler.samples,
+                    )
+
+    def _write(self, sampler, filename):
+        """ Write a profile and prune old ones. Returns False on error. """
+        tmp = None
+        try:
+            # Write to a temporary file first so nobody reads a partial profile
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            os.close(fd)
+            sampler.write(tmp)
+            os.replace(tmp, os.path.join(self.directory, filename))
+            self._prune()
+        except Exception:  # pylint: disable=W0703
+            LOG.exception("Error writing profile %s", filename)
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+            return False
+        return True
+
+    def _prune(self):
+        """ Delete the oldest profiles past ``max_files`` """
+        profiles = [
+            entry
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".folded") and entry.is_file()
+        ]
+        if len(profiles) <= self.max_files:
+            return
+        profiles.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in profiles[: len(profiles) - self.max_files]:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                # Another process pruned it first
+                pass
+
+
+def profiling_tween_factory(handler, registry):
+    profiler = registry.profiler
+    if profiler is None:
+        return handler
+    mapper = registry.queryUtility(IRoutesMapper)
+
+    def profiling_tween(request):
+        if not profiler.should_profile():
+            return handler(request)
+        # The route is only matched below this tween, so match it here. The
+        # path would be untrusted input in a file name.
+        route = mapper(request)["route"]
+        name = "notfound" if route is None else route.name
+        with profiler.profile("request-" + name):
+            return handler(request)
+
+    return profiling_tween
+
+
+def create_profiler(settings):
+    """ Create a :class:`Profiler` from the settings, or None if disabled """
+    directory = settings.get("profiling.directory")
+    if not directory:
+        return None
+    return Profiler(
+        directory,
+        float(settings.get("profiling.sample_rate", 0)),
+        float(settings.get("profiling.interval", 0.005)),
+        settings.get("profiling.trigger"),
+        int(settings.get("profiling.max_files", 1000)),
+    )
+
+
+def includeme(config):
+    config.registry.profiler = create_profiler(config.get_settings())
+    # Above pyramid_tm, so the profile includes the commit
+    config.add_tween(
+        "captionary.profiling.profiling_tween_factory",
+        under=INGRESS,
+        over="pyramid_tm.tm_tween_factory",
+    )
@@ -0,0 +1,307 @@
+""" Long-running process that moves contests forward at their deadlines """
+import asyncio
+import heapq
+import logging
+import os
+import select
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+import transaction
+import zope.sqlalchemy
+from .db import Config, Round, shard_for_team
+from .outbox import QueuedSlackAPI
+from .slack import AsyncSlackAPI, SlackAPI
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def parse_addresses(addresses):
+    """ Parse a comma-separated list of host:port, one for each shard """
+    return [parse_address(address.strip()) for address in addresses.split(",")]
+
+
+def notify(request, team_id, channel):
+    """
+    Wake up the team's scheduler shard after the current transaction commits
+
+    The scheduler re-reads the channel's deadline from the database, so the
+    message only needs to carry the team and channel ids. If no scheduler is
+    listening the datagram is simply dropped.
+
+    """
+    addresses = request.registry.scheduler_addresses
+    address = addresses[shard_for_team(team_id, len(addresses))]
+
+    def send(success):
+        if not success:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            message = "%s %s" % (team_id, channel)
+            sock.sendto(message.encode("utf-8"), address)
+        except socket.error:
+            LOG.warning("Could not notify scheduler of new deadline in %s", channel)
+        finally:
+            sock.close()
+
+    request.tm.get().addAfterCommitHook(send)
+
+
+def lease_owner():
+    """ Unique id for this process in the contest leases """
+    return "%s:%d:%s" % (socket.gethostname()[:40], os.getpid(), uuid.uuid4().hex[:8])
+
+
+def compact_rounds(registry):
+    """
+    Delete the rounds that ended more than ``rounds.keep`` seconds ago
+
+    Each batch of ``rounds.compact_batch`` rounds is committed on its own, so
+    the write lock is only held briefly. Returns the number of rounds deleted.
+
+    """
+    settings = registry.settings
+    before = datetime.utcnow() - timedelta(
+        seconds=float(settings.get("rounds.keep", 24 * 60 * 60))
+    )
+    batch_size = int(settings.get("rounds.compact_batch", 100))
+    total = 0
+    while True:
+        db = registry.dbmaker()
+        try:
+            count = Round.compact(db, before, batch_size)
+            db.commit()
+        finally:
+            db.close()
+        total += count
+        if count < batch_size:
+            return total
+
+
+class JobRequest(object):
+
+    """
+    Request-like object for running actions outside of a web request
+
+    Each JobRequest has its own explicit transaction manager instead of the
+    thread-local one, so several of them can be in flight on one thread.
+
+    Parameters
+    ----------
+    registry : :class:`pyramid.registry.Registry`
+    team_id : str
+        The Slack team the job acts on
+    aslack : :class:`~captionary.slack.AsyncSlackAPI`, optional
+        Share this API's connections instead of opening new ones
+
+    """
+
+    def __init__(self, registry, team_id, aslack=None):
+        self.registry = registry
+        self.team_id = team_id
+        self.tm = transaction.TransactionManager(explicit=True)
+        self.db = registry.dbmaker()
+        zope.sqlalchemy.register(self.db, transaction_manager=self.tm)
+        self.slack = SlackAPI(registry, team_id)
+        self.aslack = (aslack or AsyncSlackAPI(registry)).for_team(team_id)
+        self.outbox = QueuedSlackAPI(self)
+
+    def close(self):
+        self.db.close()
+
+
+class Scheduler(object):
+
+    """
+    Keeps a min-heap of contest deadlines and sleeps until the next one
+
+    Deadlines are keyed by (team_id, channel). With more than one entry in
+    ``scheduler.address``, each scheduler process is one shard: it only
+    loads the teams that hash to it, and listens on its own address.
+
+    Due contests are leased in the database before they are processed (see
+    :meth:`~captionary.db.Config.claim_due`), so several processes can run
+    the same shard, on one or more hosts, without moving a contest forward
+    twice. If a process dies, its leases expire after ``scheduler.lease``
+    seconds and another one picks the contests up.
+
+    Parameters
+    ----------
+    registry : :class:`pyramid.registry.Registry`
+    callback : callable
+        Coroutine function called with (request, channel) inside a
+        transaction when a channel's deadline passes. All channels that are
+        due at the same time are processed concurrently.
+    resync_interval : float
+        Reload every deadline from the database this often (seconds), in
+        case a notification was lost. The first shard also compacts old
+        rounds this often.
+    shard : int, optional
+        Index of this process in ``scheduler.address`` (default 0)
+    address : tuple, optional
+        Listen on this (host, port) instead of the shard's address, to run an
+        extra process for the shard. It only learns about new deadlines when
+        it resyncs.
+
+    """
+
+    def __init__(self, registry, callback, resync_interval=300, shard=0, address=None):
+        self.registry = registry
+        self.callback = callback
+        self.resync_interval = resync_interval
+        addresses = registry.scheduler_addresses
+        self.shard = (shard, len(addresses))
+        self.address = address or addresses[shard]
+        self.owner = lease_owner()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(self.address)
+        self._heap = []
+        self._deadlines = {}
+        self.loop = asyncio.new_event_loop()
+        self.aslack = AsyncSlackAPI(registry)
+
+    def schedule(self, key, end_dt):
+        if end_dt is None:
+            self._deadlines.pop(key, None)
+        elif self._deadlines.get(key) != end_dt:
+            # Any older heap entry for the channel becomes stale and is
+            # skipped when it is popped
+            self._deadlines[key] = end_dt
+            heapq.heappush(self._heap, (end_dt, key))
+
+    def load(self, keys=None):
+        """ Reload the deadlines of some (team_id, channel) keys, or all """
+        db = self.registry.dbmaker()
+        try:
+            rows = Config.get_deadlines(db, keys, self.shard)
+        finally:
+            db.close()
+        # Give the caption batches of the web workers time to commit
+        grace = timedelta(seconds=self.registry.caption_flush_interval)
+        deadlines = dict(
+            ((team_id, channel), end + grace) for team_id, channel, end in rows
+        )
+        if keys is None:
+            keys = set(self._deadlines) | set(deadlines)
+        for key in keys:
+            self.schedule(key, deadlines.get(key))
+
+    def claim(self):
+        """ Lease the due contests of this shard and return their keys """
+        db = self.registry.dbmaker()
+        try:
+            keys = Config.claim_due(
+                db,
+                self.owner,
+                self.registry.scheduler_lease,
+                shard=self.shard,
+                grace=self.registry.caption_flush_interval,
+            )
+            db.commit()
+        finally:
+            db.close()
+        return keys
+
+    async def process(self, team_id, channel):
+        request = JobRequest(self.registry, team_id, self.aslack)
+        try:
+            with request.tm:
+                config = Config.get_config(request.db, team_id, channel)
+                if config is not None and config.lease_owner == self.owner:
+                    await self.callback(request, channel)
+                    Config.release(request.db, team_id, channel, self.owner)
+        except Exception:  # pylint: disable=W0703
+            LOG.exception("Error moving contest forward on %s %s", team_id, channel)
+        finally:
+            request.close()
+
+    async def process_all(self, keys):
+        await asyncio.gather(*[self.process(*key) for key in keys])
+
+    def run_due(self):
+        due = []
+        while self._heap and self._heap[0][0] <= datetime.utcnow():
+            end_dt, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) != end_dt:
+                continue
+            del self._deadlines[key]
+            due.append(key)
+        if due:
+            keys = self.claim()
+            profiler = self.registry.profiler
+            if keys and profiler is not None and profiler.should_profile_tick():
+                with profiler.profile("scheduler"):
+                    self.loop.run_until_complete(self.process_all(keys))
+            else:
+                self.loop.run_until_complete(self.process_all(keys))
+            # Contests leased by another process come back with the lease's
+            # expiry as their deadline
+            self.load(set(due) | set(keys))
+
+    def _read_notifications(self):
+        keys = set()
+        while True:
+            try:
+                data = self.sock.recv(1024)
+            except socket.error:
+                break
+            try:
+                team_id, channel = data.decode("utf-8").split(" ", 1)
+            except ValueError:
+                # Also covers UnicodeDecodeError
+                LOG.warning("Ignoring malformed notification %r", data[:100])
+                continue
+            keys.add((team_id, channel))
+        return keys
+
+    def run(self):
+        LOG.info(
+            "Scheduler shard %d/%d listening on %s:%d",
+            self.shard[0],
+            self.shard[1],
+            *self.address
+        )
+        self.sock.setblocking(False)
+        self.load()
+        next_resync = time.time() + self.resync_interval
+        while True:
+            self.run_due()
+            timeout = next_resync - time.time()
+            if self._heap:
+                until_due = (self._heap[0][0] - datetime.utcnow()).total_seconds()
+                timeout = min(timeout, until_due)
+            readable, _, _ = select.select([self.sock], [], [], max(timeout, 0))
+            if readable:
+                keys = self._read_notifications()
+                if keys:
+                    self.load(keys)
+            if time.time() >= next_resync:
+                self.load()
+                self.compact()
+                next_resync = time.time() + self.resync_interval
+
+    def compact(self):
+        if self.shard[0] != 0:
+            return
+        try:
+            count = compact_rounds(self.registry)
+        except Exception:  # pylint: disable=W0703
+            LOG.exception("Error compacting old rounds")
+        else:
+            if count:
+                LOG.info("Compacted %d old rounds", count)
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.scheduler_addresses = parse_addresses(
+        settings.get("scheduler.address", "127.0.0.1:6545")
+    )
+    config.registry.scheduler_lease = float(settings.get("scheduler.lease", 300))
@@ -1,17 +1,175 @@
+import asyncio
+import functools
 import requests
 import logging
+import threading
+import time
+from collections import Counter
+from requests.adapters import HTTPAdapter
+from .metrics import record_slack_call
+
+# Imported on first use, since it is slow and only the scheduler needs it
+_aiohttp = False
 
 
 LOG = logging.getLogger(__name__)
 
+# Requests per minute for each API method, from Slack's rate limit tiers
+METHOD_LIMITS = {
+    "chat.postMessage": 60,
+    "chat.postEphemeral": 100,
+    "chat.delete": 50,
+    "reactions.add": 50,
+}
+# Tier 2, which applies to most other methods
+DEFAULT_METHOD_LIMIT = 20
+# Slack allows roughly one message per second in each channel
+CHANNEL_LIMIT = 60
+CHANNEL_LIMITED_METHODS = ("chat.postMessage",)
+
 
 class SlackException(Exception):
     pass
 
 
+class TokenBucket(object):
+
+    """
+    Token bucket that hands out reservations instead of rejecting calls
+
+    Parameters
+    ----------
+    per_minute : float
+        Sustained number of calls allowed per minute
+    burst : float, optional
+        Number of calls that can be made at once after the bucket has been
+        idle (default 1/6 of per_minute, at least 1)
+
+    """
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or max(1, per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def _refill(self, now):
+        elapsed = max(0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """ Take a token and return how many seconds to wait before using it """
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def pause(self, now, seconds):
+        """ Don't hand out any tokens for the next ``seconds`` """
+        self._refill(now)
+        # The next reservation will wait exactly ``seconds``
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class SlackDispatcher(object):
+
+    """
+    Throttles Slack calls with a token bucket per API method and per channel
+
+    Slack applies the method limits to each team separately, so each team
+    gets its own method buckets. Calls over the limit are delayed rather than
+    dropped. The limits are per process.
+
+    Parameters
+    ----------
+    method_limits : dict, optional
+        Mapping of API method to calls per minute. Methods not listed use
+        DEFAULT_METHOD_LIMIT.
+    channel_limit : float, optional
+        Messages per minute allowed in a single channel
+
+    """
+
+    def __init__(self, method_limits=None, channel_limit=CHANNEL_LIMIT):
+        self.method_limits = dict(METHOD_LIMITS)
+        self.method_limits.update(method_limits or {})
+        self.channel_limit = channel_limit
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._waiting = 0
+        self._counters = Counter()
+
+    def _bucket(self, key, per_minute):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(per_minute)
+        return bucket
+
+    def _method_bucket(self, method, team_id):
+        limit = self.method_limits.get(method, DEFAULT_METHOD_LIMIT)
+        return self._bucket(("method", team_id, method), limit)
+
+    def reserve(self, method, channel=None, team_id=""):
+        """ Reserve a call slot and return how many seconds to wait for it """
+        with self._lock:
+            now = time.time()
+            delay = self._method_bucket(method, team_id).reserve(now)
+            if channel is not None and method in CHANNEL_LIMITED_METHODS:
+                bucket = self._bucket(("channel", channel), self.channel_limit)
+                delay = max(delay, bucket.reserve(now))
+            self._counters["calls"] += 1
+            if delay > 0:
+                self._counters["throttled"] += 1
+                self._counters["throttled_" + method] += 1
+            return delay
+
+    def _queued(self, delta):
+        with self._lock:
+            self._waiting += delta
+
+    def wait(self, method, channel=None, team_id=""):
+        """ Block until a call to ``method`` is allowed """
+        delay = self.reserve(method, channel, team_id)
+        if delay <= 0:
+            return
+        self._queued(1)
+        try:
+            time.sleep(delay)
+        finally:
+            self._queued(-1)
+
+    async def wait_async(self, method, channel=None, team_id=""):
+        """ Coroutine version of :meth:`wait` """
+        delay = self.reserve(method, channel, team_id)
+        if delay <= 0:
+            return
+        self._queued(1)
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._queued(-1)
+
+    def backoff(self, method, retry_after, team_id=""):
+        """ Slack returned a 429; hold all calls to ``method`` until it's over """
+        with self._lock:
+            self._method_bucket(method, team_id).pause(time.time(), retry_after)
+            self._counters["rate_limited"] += 1
+            self._counters["rate_limited_" + method] += 1
+
+    def get_stats(self):
+        """ Get the current queue depth and the throttle counters """
+        with self._lock:
+            stats = dict(self._counters)
+            stats["queue_depth"] = self._waiting
+        return stats
+
+
 class SlackAPI(object):
-    def __init__(self, request):
-        self.request = request
+    def __init__(self, registry, team_id=""):
+        self.registry = registry
+        self.team_id = team_id
 
     def post(self, channel, text, **kwargs):
         body = {"channel": channel, "text": text}
@@ -32,20 +190,183 @@ class SlackAPI(object):
         body.update(kwargs)
         return self.call("/reactions.add", body)
 
+    def _prepare(self, path):
+        """ Get the url and headers for a call """
+        token = self.registry.slack_tokens.get(self.team_id)
+        headers = {"Authorization": "Bearer " + token}
+        return self.registry.slack_api_url + path, headers
+
     def call(self, path, body):
-        headers = {"Authorization": "Bearer " + self.request.registry.oauth_token}
-        resp = requests.post(
-            "https://slack.com/api/" + path, headers=headers, json=body
-        )
+        url, headers = self._prepare(path)
+        method = path.lstrip("/")
+        dispatcher = self.registry.slack_dispatcher
+        while True:
+            dispatcher.wait(method, body.get("channel"), self.team_id)
+            start = time.perf_counter()
+            resp = self.registry.slack_session.post(
+                url, headers=headers, json=body, timeout=self.registry.slack_timeout
+            )
+            record_slack_call(self.registry, method, time.perf_counter() - start)
+            if resp.status_code != 429:
+                break
+            dispatcher.backoff(method, _retry_after(method, resp.headers), self.team_id)
         resp.raise_for_status()
-        data = resp.json()
-        if not data["ok"]:
-            LOG.error(
-                "Slack API error. path: %s body: %s response: %s", path, body, data
+        return _check_response(path, body, resp.json())
+
+
+class AsyncSlackAPI(SlackAPI):
+
+    """
+    SlackAPI for use inside an asyncio event loop
+
+    All of the API methods return coroutines. Uses aiohttp if it is
+    installed, otherwise runs the pooled requests session in the loop's
+    default executor.
+
+    """
+
+    def __init__(self, registry, team_id=""):
+        super(AsyncSlackAPI, self).__init__(registry, team_id)
+        self._session = None
+        self._root = self
+
+    def for_team(self, team_id):
+        """ Get an AsyncSlackAPI for a team that shares this one's connections """
+        api = AsyncSlackAPI(self.registry, team_id)
+        api._root = self._root
+        return api
+
+    async def _post(self, url, headers, body):
+        """ Make the HTTP call and return (status, headers, json data) """
+        connect_timeout, read_timeout = self.registry.slack_timeout
+        aiohttp = _get_aiohttp()
+        if aiohttp is None:
+            loop = asyncio.get_event_loop()
+            resp = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    self.registry.slack_session.post,
+                    url,
+                    headers=headers,
+                    json=body,
+                    timeout=self.registry.slack_timeout,
+                ),
+            )
+            if resp.status_code == 429:
+                return resp.status_code, resp.headers, None
+            resp.raise_for_status()
+            return resp.status_code, resp.headers, resp.json()
+
+        root = self._root
+        if root._session is None:
+            root._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=connect_timeout, sock_read=read_timeout
+                )
             )
-            raise SlackException("Slack API exception: " + data["error"])
-        return data
+        async with root._session.post(url, headers=headers, json=body) as resp:
+            if resp.status == 429:
+                return resp.status, resp.headers, None
+            resp.raise_for_status()
+            return resp.status, resp.headers, await resp.json()
+
+    async def call(self, path, body):
+        url, headers = self._prepare(path)
+        method = path.lstrip("/")
+        dispatcher = self.registry.slack_dispatcher
+        while True:
+            await dispatcher.wait_async(method, body.get("channel"), self.team_id)
+            start = time.perf_counter()
+            status, resp_headers, data = await self._post(url, headers, body)
+            record_slack_call(self.registry, method, time.perf_counter() - start)
+            if status != 429:
+                break
+            dispatcher.backoff(method, _retry_after(method, resp_headers), self.team_id)
+        return _check_response(path, body, data)
+
+    async def close(self):
+        root = self._root
+        if root._session is not None:
+            await root._session.close()
+            root._session = None
+
+
+def _get_aiohttp():
+    """ Import aiohttp, or return None if it is not installed """
+    global _aiohttp  # pylint: disable=W0603
+    if _aiohttp is False:
+        try:
+            import aiohttp as _aiohttp
+        except ImportError:
+            _aiohttp = None
+    return _aiohttp
+
+
+def _retry_after(method, headers):
+    retry_after = float(headers.get("Retry-After", 1))
+    LOG.warning("Rate limited on %s. Retrying in %ss", method, retry_after)
+    return retry_after
+
+
+def _check_response(path, body, data):
+    if not data["ok"]:
+        LOG.error("Slack API error. path: %s body: %s response: %s", path, body, data)
+        raise SlackException("Slack API exception: " + data["error"])
+    return data
+
+
+def get_slack(request):
+    return SlackAPI(request.registry, request.team_id)
+
+
+def create_session(settings):
+    """ Create a keep-alive HTTP session with a connection pool for Slack """
+    pool_size = int(settings.get("slack.pool_size", 10))
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def create_dispatcher(settings):
+    """
+    Create the SlackDispatcher
+
+    Limits can be overridden with ``slack.rate_limit.<method>`` and
+    ``slack.rate_limit.channel`` (calls per minute).
+
+    """
+    prefix = "slack.rate_limit."
+    method_limits = {}
+    for key, value in settings.items():
+        if key.startswith(prefix):
+            method_limits[key[len(prefix) :]] = float(value)
+    channel_limit = method_limits.pop("channel", CHANNEL_LIMIT)
+    return SlackDispatcher(method_limits, channel_limit)
 
 
 def includeme(config):
-    config.add_request_method(SlackAPI, name="slack", reify=True)
+    settings = config.get_settings()
+    config.registry.slack_dispatcher = create_dispatcher(settings)
+    config.registry.slack_api_url = settings.get(
+        "slack.api_url", "https://slack.com/api"
+    ).rstrip("/")
+    config.registry.slack_timeout = (
+        float(settings.get("slack.connect_timeout", 3.05)),
+        float(settings.get("slack.read_timeout", 10)),
+    )
+    config.registry.slack_session = create_session(settings)
+    config.add_request_method(get_slack, name="slack", reify=True)
+
+    try:
+        from uwsgidecorators import postfork
+    except ImportError:
+        pass
+    else:
+
+        @postfork
+        def run_postfork_hooks():
+            """ Don't share pooled sockets with the uWSGI master """
+            config.registry.slack_session.close()
+            config.registry.slack_session = create_session(settings)
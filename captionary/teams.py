@@ -0,0 +1,75 @@
+""" Slack workspaces (teams) and their OAuth tokens """
+import json
+import os
+import threading
+import time
+from .db import Team
+from .slack import SlackException
+
+
+class TokenStore(object):
+
+    """
+    Looks up each team's OAuth token, with an in-memory cache
+
+    Teams without a row in the teams table use ``default_token``, which is
+    how a single-workspace deployment keeps working with just
+    ``slack.oauth_token``.
+
+    Parameters
+    ----------
+    registry : :class:`pyramid.registry.Registry`
+    default_token : str, optional
+    ttl : float, optional
+        Seconds to cache a token (default 300)
+
+    """
+
+    def __init__(self, registry, default_token=None, ttl=300):
+        self.registry = registry
+        self.default_token = default_token
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    def get(self, team_id):
+        with self._lock:
+            entry = self._tokens.get(team_id)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+        db = self.registry.dbmaker()
+        try:
+            token = Team.get_token(db, team_id)
+        finally:
+            db.close()
+        if token is None:
+            token = self.default_token
+        if token is None:
+            raise SlackException("No Slack token for team %r" % team_id)
+        with self._lock:
+            self._tokens[team_id] = (token, time.time() + self.ttl)
+        return token
+
+    def invalidate(self, team_id):
+        with self._lock:
+            self._tokens.pop(team_id, None)
+
+
+def get_team_id(request):
+    """ Find the Slack team that sent an event, command or interaction """
+    if request.content_type == "application/json":
+        return request.json_body.get("team_id", "")
+    if "payload" in request.POST:
+        payload = json.loads(request.POST["payload"])
+        return payload.get("team", {}).get("id", "")
+    return request.POST.get("team_id", "")
+
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.slack_tokens = TokenStore(
+        config.registry,
+        settings.get("slack.oauth_token") or os.environ.get("OAUTH_TOKEN"),
+        float(settings.get("slack.token_cache_ttl", 300)),
+    )
+    config.add_request_method(get_team_id, name="team_id", reify=True)
@@ -8,8 +8,12 @@ from pyramid_duh import argify
 from pyramid.httpexceptions import HTTPException, HTTPNotFound
 from pyramid.settings import asbool
 from pyramid.view import view_config
-from .actions import start_contest, proceed_contest
+from .actions import start_contest
+from .batch import add_submission
+from .dedupe import idempotent
+from .leaderboard import leaderboard_text
 from .db import Config, Caption, Vote, State
+from .scheduler import notify
 from .util import format_timedelta
 
 
@@ -17,10 +21,11 @@ LOG = logging.getLogger(__name__)
 HELP = """Hello! I am a caption contest bot.
 1. You can start a new caption contest by uploading a photo and mentioning me in the message
 2. People can submit captions with `/caption`
-3. I'll post everyone's submissions and you can vote on the best ones!"""
+3. I'll post everyone's submissions and you can vote on the best ones!
+4. `/caption leaderboard` shows who has won the most contests in a channel"""
 
 
-@view_config(route_name="event", renderer="json")
+@view_config(route_name="event", renderer="json", decorator=idempotent)
 def handle_event(request):
     if "challenge" in request.json_body:
         request.response.text = request.json_body["challenge"]
@@ -33,7 +38,7 @@ def handle_event(request):
 def handle_slack_event(request, event):
     if event["type"] == "app_mention":
         if not check_for_image(request, event):
-            request.slack.post(
+            request.outbox.post(
                 event["channel"],
                 "Mention me when you post an image to start a caption contest",
             )
@@ -46,7 +51,7 @@ def handle_im(request, event):
     text = event["text"]
     if event.get("subtype") == "bot_message":
         return
-    request.slack.post(event["channel"], HELP)
+    request.outbox.post(event["channel"], HELP)
 
 
 def check_for_image(request, event):
@@ -62,45 +67,55 @@ def check_for_image(request, event):
     return True
 
 
-@view_config(route_name="command", renderer="json")
+@view_config(route_name="command", renderer="json", decorator=idempotent)
 @argify
-def handle_command(request, command, text, channel_id):
+def handle_command(request, command, text, channel_id, user_id=None):
     channel = channel_id
     if command == "/caption":
+        if text == "leaderboard":
+            request.response.text = leaderboard_text(
+                request.db, request.team_id, channel
+            )
+            return request.response
         response = debug_command(request, channel, text)
         if response is not None:
             request.response.text = response
             return request.response
-        state = Config.get_contest_state(request.db, channel)
+        state = Config.get_contest_state(request.db, request.team_id, channel)
         if state != State.captioning:
             request.response.text = "Not accepting captions right now, thx"
             return request.response
         LOG.info("Adding a submission to channel %s: %s", channel, text)
-        Caption.add_submission(request.db, channel, text)
+        if not add_submission(request, channel, text, user_id):
+            request.response.text = "Not accepting captions right now, thx"
+            return request.response
         return {"text": "_" + text + "_", "mrkdwn": True}
     return HTTPNotFound("Unrecognized command %s" % command)
 
 
 def debug_command(request, channel, text):
     if text == "we done":
-        proceed_contest(request, channel)
+        # Let the scheduler move the contest forward right away
+        config = Config.get_config(request.db, request.team_id, channel)
+        if config is not None and config.state is not None:
+            Config.set_deadline(request.db, config, datetime.utcnow())
+            notify(request, request.team_id, channel)
         return ""
     elif text in ("debug", "status"):
-        config = Config.get_config(request.db, channel)
+        config = Config.get_config(request.db, request.team_id, channel)
         if config is None:
             return "Not much going on atm"
-        state = config.value.get("state")
+        state = config.state
         now = datetime.utcnow()
         message = "State: %s" % state
-        if "end" in config.value:
-            end_dt = datetime.utcfromtimestamp(config.value.get("end"))
+        end_dt = config.end_dt
         if state == State.captioning:
             message += "\nVoting starts in " + format_timedelta(end_dt - now)
-            captions = Caption.get_captions(request.db, channel)
+            captions = Caption.get_captions(request.db, config.round_id)
             message += "\n%d captions submitted" % len(captions)
         elif state == State.voting:
             message += "\nVoting closes in " + format_timedelta(end_dt - now)
-            captions = Caption.get_captions_and_votes(request.db, channel)
+            captions = Caption.get_captions_and_votes(request.db, config.round_id)
             captions.sort(reverse=True)
             for count, caption in captions:
                 message += "\n%s - %s" % (count, caption)
@@ -108,18 +123,29 @@ def debug_command(request, channel, text):
         return message
 
 
-@view_config(route_name="vote", renderer="json")
+@view_config(route_name="vote", renderer="json", decorator=idempotent)
 @argify
 def handle_vote(request, payload):
+    # Block Kit and legacy attachment buttons both send these fields
     payload = json.loads(payload)
-    file_id = payload["callback_id"]
     channel = payload["channel"]["id"]
     user = payload["user"]["id"]
-    vote = payload["actions"][0]["value"]
-    Vote.toggle_vote(request.db, user, int(vote))
-    votes = Caption.get_votes(request.db, user, channel)
+    caption_id = int(payload["actions"][0]["value"])
+    round_id = Caption.get_voting_round_id(
+        request.db, request.team_id, channel, caption_id
+    )
+    if round_id is None:
+        # A button on a ballot from a contest that has ended, or a caption
+        # from another channel
+        return request.response
+    Vote.toggle_vote(request.db, user, caption_id, round_id)
+    votes = Caption.get_votes(request.db, user, round_id)
     text = "*Your votes:*\n" + "\n".join([vote.caption for vote in votes])
-    request.slack.post_ephemeral(channel, user, text, mrkdwn=True)
+    # Only send the latest state when the user clicks several times in a row
+    outbox = request.outbox.coalesced(
+        "votes:%s:%s:%s" % (request.team_id, channel, user)
+    )
+    outbox.post_ephemeral(channel, user, text, mrkdwn=True)
     return request.response
 
 
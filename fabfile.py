@@ -14,6 +14,11 @@ def _get_var(key):
 CONSTANTS = {
     "venv": "/envs/captionary",
     "OAUTH_TOKEN": _get_var("OAUTH_TOKEN"),
+    # Existing contests are assigned to this workspace by captionary-migrate
+    "TEAM_ID": os.environ.get("TEAM_ID", ""),
+    # Signs the /images urls, and the public url they are served under
+    "IMAGES_SECRET": _get_var("IMAGES_SECRET"),
+    "BASE_URL": _get_var("BASE_URL"),
     "conf": "/etc/emperor/captionary.ini",
 }
 
@@ -64,9 +69,10 @@ def do_deploy(local, remote):
     remote.sudo(pip + " install pastescript")
     remote.sudo(pip + " install %s" % tarball)
     _render_put(remote, "prod.ini.tmpl", "captionary.ini")
-    remote.sudo("rm -f captionary")
-    _render_put(remote, "cron.tmpl", "captionary")
-    remote.sudo("chmod 644 captionary")
-    remote.sudo("chown root:root captionary")
-    remote.sudo("mv captionary /etc/cron.d")
+    # Migrate with the staged config before the emperor sees the new one and
+    # reloads the app, which doesn't migrate the schema itself
+    migrate = os.path.join(CONSTANTS["venv"], "bin", "captionary-migrate")
+    remote.sudo(migrate + " captionary.ini")
+    # The scheduler now runs as a uWSGI attached daemon
+    remote.sudo("rm -f /etc/cron.d/captionary")
     remote.sudo("mv captionary.ini %s" % CONSTANTS["conf"])
@@ -13,12 +13,17 @@ REQUIREMENTS = [
     "pyramid_duh",
     "pyramid_tm",
     "requests",
-    "transaction",
+    "transaction>=3.0",
     "zope.sqlalchemy",
 ]
 
 EXTRAS = {
+    "async": ["aiohttp"],
+    "fastjson": ["orjson"],
+    "images": ["Pillow"],
+    "postgres": ["psycopg2"],
     "lint": ["black", "pylint==2.1.1"],
+    "test": ["pytest", "webtest"],
     "dev": ["fabric", "invoke", "waitress", "jinja2"],
 }
 
@@ -44,13 +49,20 @@ if __name__ == "__main__":
         platforms="any",
         zip_safe=False,
         include_package_data=True,
-        packages=find_packages(),
+        packages=find_packages(exclude=("bench", "bench.*")),
         entry_points={
-            "console_scripts": ["process_queue = captionary.cli:process_queue"],
+            "console_scripts": [
+                "process_queue = captionary.cli:process_queue",
+                "captionary-scheduler = captionary.cli:run_scheduler",
+                "captionary-check-votes = captionary.cli:check_votes",
+                "captionary-compact = captionary.cli:compact",
+                "captionary-migrate = captionary.cli:migrate_db",
+                "captionary-add-team = captionary.cli:add_team",
+            ],
             "paste.app_factory": ["main = captionary:main"],
         },
         install_requires=REQUIREMENTS,
-        tests_require=REQUIREMENTS,
+        tests_require=REQUIREMENTS + EXTRAS["test"],
         test_suite="tests",
         extras_require=EXTRAS,
     )
@@ -0,0 +1,25 @@
+""" Fixtures shared by the tests """
+import pytest
+from pyramid.config import Configurator
+
+
+@pytest.fixture
+def settings(tmp_path):
+    """ Settings for an app on a fresh SQLite database """
+    return {
+        "db.url": "sqlite:///%s" % tmp_path.joinpath("db.sqlite"),
+        "schema.auto_migrate": "true",
+        "slack.oauth_token": "xoxb-test",
+        "outbox.workers": "0",
+    }
+
+
+@pytest.fixture
+def config(settings):
+    """ A Configurator with the database and the outbox, but no views """
+    config = Configurator(settings=settings)
+    config.include("pyramid_tm")
+    config.include("captionary.db")
+    config.include("captionary.teams")
+    config.include("captionary.outbox")
+    return config
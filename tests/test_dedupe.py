@@ -0,0 +1,113 @@
+""" Tests for answering repeated Slack deliveries """
+from datetime import datetime, timedelta
+import pytest
+from webtest import TestApp
+from captionary.batch import add_submission
+from captionary.db import Caption, Config, Delivery, Round, State, team_shard_key
+from captionary.dedupe import idempotent
+
+
+@pytest.fixture(params=[False, True], ids=["sync", "write_behind"])
+def settings(settings, request):
+    settings["captions.write_behind"] = str(request.param).lower()
+    return settings
+
+
+def caption_view(request):
+    request.registry.view_calls += 1
+    if request.POST["text"] == "fail":
+        raise ValueError("Failed to handle the command")
+    added = add_submission(request, "C1", request.POST["text"], "U1")
+    return {"text": request.POST["text"], "added": added}
+
+
+@pytest.fixture
+def registry(config):
+    config.include("captionary.dedupe")
+    config.include("captionary.batch")
+    config.add_route("command", "/command")
+    config.add_view(
+        caption_view, route_name="command", renderer="json", decorator=idempotent
+    )
+    config.registry.view_calls = 0
+    db = config.registry.dbmaker()
+    db.add(
+        Config(
+            team_id="T1",
+            channel="C1",
+            shard_key=team_shard_key("T1"),
+            state=State.captioning,
+            round_id=Round.start(db, "T1", "C1"),
+            end_dt=datetime.utcnow() + timedelta(hours=1),
+            value={},
+        )
+    )
+    db.commit()
+    db.close()
+    return config.registry
+
+
+@pytest.fixture
+def app(config, registry):
+    return TestApp(config.make_wsgi_app())
+
+
+def post(app, text, trigger_id="TR1", retry=None):
+    params = {"team_id": "T1", "channel_id": "C1", "text": text}
+    if trigger_id is not None:
+        params["trigger_id"] = trigger_id
+    headers = {} if retry is None else {"X-Slack-Retry-Num": str(retry)}
+    return app.post("/command", params, headers=headers)
+
+
+def captions(registry):
+    db = registry.dbmaker()
+    try:
+        return [caption.caption for caption in db.query(Caption)]
+    finally:
+        db.close()
+
+
+def test_repeat_answered_from_cache(app, registry):
+    """ A repeat in the same process gets the first response """
+    first = post(app, "hello")
+    second = post(app, "hello", retry=1)
+    assert second.json == first.json == {"text": "hello", "added": True}
+    assert registry.view_calls == 1
+    assert registry.deliveries.duplicates == 1
+    assert captions(registry) == ["hello"]
+
+
+def test_retry_after_restart(app, registry):
+    """ A retry that isn't in the cache doesn't add the caption again """
+    first = post(app, "hello")
+    registry.deliveries._entries.clear()  # pylint: disable=W0212
+    second = post(app, "hello", retry=1)
+    assert second.json == first.json
+    assert captions(registry) == ["hello"]
+
+
+def test_without_delivery_id(app, registry):
+    """ Requests without a trigger_id are always handled """
+    post(app, "hello", None)
+    post(app, "hello", None)
+    assert registry.view_calls == 2
+    assert captions(registry) == ["hello", "hello"]
+
+
+def test_different_deliveries(app, registry):
+    post(app, "hello", "TR1")
+    post(app, "hello", "TR2")
+    assert captions(registry) == ["hello", "hello"]
+
+
+def test_failure_not_recorded(app, registry):
+    """ A delivery that failed is handled again when Slack retries it """
+    with pytest.raises(ValueError):
+        post(app, "fail")
+    db = registry.dbmaker()
+    assert db.query(Delivery).count() == 0
+    db.close()
+    with pytest.raises(ValueError):
+        post(app, "fail", retry=1)
+    assert registry.view_calls == 2
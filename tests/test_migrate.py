@@ -0,0 +1,114 @@
+""" Tests for upgrading a database made by the first version of the schema """
+import calendar
+import json
+from datetime import datetime
+import pytest
+from sqlalchemy import func, inspect, select
+from sqlalchemy.orm import Session
+from captionary.db import (
+    Caption,
+    Config,
+    Outbox,
+    Round,
+    State,
+    Vote,
+    create_engine,
+    init_schema,
+    team_shard_key,
+)
+
+BASELINE = [
+    """
+    CREATE TABLE configs (
+        channel VARCHAR(20) NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (channel)
+    )
+    """,
+    """
+    CREATE TABLE captions (
+        id INTEGER NOT NULL,
+        channel VARCHAR(20) NOT NULL,
+        caption TEXT NOT NULL,
+        PRIMARY KEY (id)
+    )
+    """,
+    "CREATE INDEX ix_captions_channel ON captions (channel)",
+    """
+    CREATE TABLE votes (
+        user VARCHAR(20) NOT NULL,
+        caption_id INTEGER NOT NULL,
+        PRIMARY KEY (user, caption_id),
+        FOREIGN KEY(caption_id) REFERENCES captions (id) ON DELETE CASCADE
+    )
+    """,
+]
+END = datetime(2030, 1, 1, 12)
+
+
+@pytest.fixture
+def engine(settings):
+    """ A database with the baseline tables and a contest in each state """
+    engine = create_engine(settings)
+    with engine.begin() as conn:
+        for ddl in BASELINE:
+            conn.execute(ddl)
+        values = {
+            "C1": {"state": "voting", "end": calendar.timegm(END.utctimetuple())},
+            "C2": {"file_id": "F2"},
+        }
+        for channel, value in values.items():
+            conn.execute(
+                "INSERT INTO configs (channel, value) VALUES (?, ?)",
+                channel,
+                json.dumps(value),
+            )
+        for caption_id, caption in ((1, "a"), (2, "b")):
+            conn.execute(
+                "INSERT INTO captions (id, channel, caption) VALUES (?, 'C1', ?)",
+                caption_id,
+                caption,
+            )
+        for user in ("U1", "U2"):
+            conn.execute("INSERT INTO votes (user, caption_id) VALUES (?, 1)", user)
+    return engine
+
+
+def test_init_schema_migrates(engine):
+    """ init_schema brings the baseline tables up to date and keeps the data """
+    init_schema(engine, "T1")
+    db = Session(bind=engine)
+    try:
+        configs = dict((config.channel, config) for config in db.query(Config))
+        voting = configs["C1"]
+        assert voting.team_id == "T1"
+        assert voting.shard_key == team_shard_key("T1")
+        assert voting.state == State.voting
+        assert voting.end_dt == END
+        assert voting.value == {}
+        assert voting.round_id is not None
+        assert configs["C2"].state is None
+        assert configs["C2"].value == {"file_id": "F2"}
+
+        captions = db.query(Caption).order_by(Caption.id).all()
+        assert [(c.team_id, c.round_id, c.vote_count) for c in captions] == [
+            ("T1", voting.round_id, 2),
+            ("T1", voting.round_id, 0),
+        ]
+        assert set(vote.round_id for vote in db.query(Vote)) == {voting.round_id}
+        assert db.query(Round).count() == 1
+    finally:
+        db.close()
+
+
+def test_init_schema_twice(engine):
+    """ Running the migrations again changes nothing """
+    init_schema(engine, "T1")
+    init_schema(engine, "T1")
+    inspector = inspect(engine)
+    columns = set(col["name"] for col in inspector.get_columns("configs"))
+    assert {"team_id", "state", "end_dt", "round_id", "locked_until"} <= columns
+    assert "outbox" in inspector.get_table_names()
+    with engine.connect() as conn:
+        assert conn.execute(select([func.count(Round.id)])).scalar() == 1
+        assert conn.execute(select([func.count(Outbox.id)])).scalar() == 0
@@ -0,0 +1,140 @@
+""" Tests for claiming and sending outbox messages """
+from datetime import datetime
+import pytest
+from captionary.db import Image, Outbox
+from captionary.outbox import OutboxWorker
+from captionary.slack import SlackException
+
+ERRORS = {"KeyError": KeyError, "SlackException": SlackException}
+
+
+@pytest.fixture
+def registry(config):
+    return config.registry
+
+
+@pytest.fixture
+def jobs(registry):
+    """ Outbox jobs that record their calls, under the paths "ok" and "fail" """
+    calls = []
+
+    def ok(registry, db, team_id, body):
+        calls.append(("ok", body["n"]))
+
+    def fail(registry, db, team_id, body):
+        calls.append(("fail", body["n"]))
+        Image.add(db, team_id, "F%d" % body["n"], "image.png")
+        raise ERRORS[body.get("error", "KeyError")]("n")
+
+    registry.outbox_jobs["ok"] = ok
+    registry.outbox_jobs["fail"] = fail
+    return calls
+
+
+def enqueue(registry, channel, path, n, **kwargs):
+    db = registry.dbmaker()
+    Outbox.enqueue(db, "T1", channel, path, dict(channel=channel, n=n, **kwargs))
+    db.commit()
+    db.close()
+
+
+def messages(registry):
+    db = registry.dbmaker()
+    try:
+        return [(msg.path, msg.body["n"], msg.attempts) for msg in db.query(Outbox)]
+    finally:
+        db.close()
+
+
+def unlock(registry):
+    """ Let the lease or backoff of every message run out """
+    db = registry.dbmaker()
+    db.query(Outbox).update({Outbox.locked_until: datetime.utcnow()})
+    db.commit()
+    db.close()
+
+
+def test_claim_oldest_per_channel(registry):
+    """ Only the oldest message of each channel can be claimed """
+    enqueue(registry, "C1", "ok", 1)
+    enqueue(registry, "C1", "ok", 2)
+    enqueue(registry, "C2", "ok", 3)
+    db = registry.dbmaker()
+    first = Outbox.claim(db, 60)
+    assert first.body["n"] == 1
+    assert Outbox.claim(db, 60).body["n"] == 3
+    assert Outbox.claim(db, 60) is None
+    Outbox.complete(db, first)
+    assert Outbox.claim(db, 60).body["n"] == 2
+    db.close()
+
+
+def test_claim_skip_paths(registry):
+    """ Messages to skipped paths are left for later """
+    enqueue(registry, "C1", "fail", 1)
+    enqueue(registry, "C2", "ok", 2)
+    db = registry.dbmaker()
+    assert Outbox.claim(db, 60, ["fail"]).body["n"] == 2
+    assert Outbox.claim(db, 60, ["fail"]) is None
+    db.close()
+
+
+def test_send_job(registry, jobs):
+    """ A job that succeeds is removed from the outbox """
+    enqueue(registry, "C1", "ok", 1)
+    assert OutboxWorker(registry).send_next()
+    assert jobs == [("ok", 1)]
+    assert messages(registry) == []
+    assert not OutboxWorker(registry).send_next()
+
+
+def test_failed_job_retried(registry, jobs):
+    """ A job that raises is rolled back and retried later """
+    enqueue(registry, "C1", "fail", 1)
+    worker = OutboxWorker(registry)
+    assert worker.send_next()
+    assert messages(registry) == [("fail", 1, 1)]
+    # Backing off
+    assert not worker.send_next()
+    db = registry.dbmaker()
+    assert Image.get_filename(db, "T1", "F1") is None
+    db.close()
+    unlock(registry)
+    assert worker.send_next()
+    assert messages(registry) == [("fail", 1, 2)]
+
+
+def test_failed_job_dropped(registry, jobs):
+    """ After max_attempts, a failing job no longer holds up its channel """
+    enqueue(registry, "C1", "fail", 1)
+    enqueue(registry, "C1", "ok", 2)
+    worker = OutboxWorker(registry, max_attempts=2)
+    assert worker.send_next()
+    unlock(registry)
+    assert worker.send_next()
+    assert messages(registry) == [("ok", 2, 0)]
+    assert worker.send_next()
+    assert jobs == [("fail", 1), ("fail", 1), ("ok", 2)]
+    assert messages(registry) == []
+
+
+def test_rejected_call_not_retried(registry, jobs):
+    """ A call that Slack rejected is dropped right away """
+    enqueue(registry, "C1", "fail", 1, error="SlackException")
+    assert OutboxWorker(registry).send_next()
+    assert messages(registry) == []
+    db = registry.dbmaker()
+    assert Image.get_filename(db, "T1", "F1") is None
+    db.close()
+
+
+def test_ready_holds_back_path(registry, jobs):
+    """ A path is not sent while its ready check returns False """
+    ready = [False]
+    registry.outbox_ready["ok"] = lambda: ready[0]
+    enqueue(registry, "C1", "ok", 1)
+    worker = OutboxWorker(registry)
+    assert not worker.send_next()
+    ready[0] = True
+    assert worker.send_next()
+    assert jobs == [("ok", 1)]